@@ -1,6 +1,16 @@
 from django.contrib import admin, messages
 
-from .models import Entity, MaterialImage, Scene, Staging
+from .models import (
+    BakedScene,
+    ChunkedUpload,
+    Entity,
+    ImportJob,
+    InstanceGroup,
+    LevelOfDetail,
+    MaterialImage,
+    Scene,
+    Staging,
+)
 
 
 class MaterialImageInline(admin.TabularInline):
@@ -8,14 +18,25 @@ class MaterialImageInline(admin.TabularInline):
     extra = 0
 
 
+class LevelOfDetailInline(admin.TabularInline):
+    model = LevelOfDetail
+    extra = 0
+
+
 @admin.register(Entity)
 class EntityAdmin(admin.ModelAdmin):
     list_display = ("title", "description")
     inlines = [
         MaterialImageInline,
+        LevelOfDetailInline,
     ]
     actions = ["check_file_names"]
 
+    def save_model(self, request, obj, form, change):
+        if change and Entity.MODEL_FIELDS & set(form.changed_data):
+            obj.forget_generated_geometry()
+        super().save_model(request, obj, form, change)
+
     @admin.action(description="Check material and image file names")
     def check_file_names(self, request, queryset):
         for ent in queryset:
@@ -35,11 +56,61 @@ class EntityAdmin(admin.ModelAdmin):
                 )
 
 
+class InstanceGroupInline(admin.TabularInline):
+    model = InstanceGroup
+    extra = 0
+
+
+class BakedSceneInline(admin.StackedInline):
+    model = BakedScene
+    extra = 0
+
+
 @admin.register(Scene)
 class SceneAdmin(admin.ModelAdmin):
     list_display = ("title", "description")
+    inlines = [
+        InstanceGroupInline,
+        BakedSceneInline,
+    ]
+    actions = ["bake"]
+
+    @admin.action(description="Bake stagings into a single model")
+    def bake(self, request, queryset):
+        for scene in queryset:
+            skipped = []
+            baked = scene.bake(skipped)
+            if skipped:
+                self.message_user(
+                    request,
+                    f"Left out stagings with malformed transforms or colors "
+                    f"of scene {scene}: {', '.join(str(st.id) for st in skipped)}",
+                    messages.WARNING,
+                )
+            if baked:
+                self.message_user(
+                    request,
+                    f"Baked {len(baked.entities)} entities of scene: {scene}",
+                    messages.SUCCESS,
+                )
+            else:
+                self.message_user(
+                    request,
+                    f"Nothing to bake in scene: {scene}",
+                    messages.WARNING,
+                )
 
 
 @admin.register(Staging)
 class StagingAdmin(admin.ModelAdmin):
     list_display = ("id", "scene", "entity")
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "scene", "status", "progress", "created", "finished")
+
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ("filename", "user", "offset", "size", "modified")
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.db.models.signals import (
+    post_delete,
+    post_migrate,
+    post_save,
+    pre_delete,
+)
 from django.utils.translation import gettext as _
 
 
@@ -21,5 +26,19 @@ class DjaframeConfig(AppConfig):
     name = "djaframe"
 
     def ready(self):
+        from . import caching, spatial
+        from .models import Entity, LevelOfDetail, MaterialImage, Staging
 
         post_migrate.connect(create_djaframe_group, sender=self)
+        # changes of what scenes show update their version, like Scene.save()
+        for model, receiver in [
+            (Staging, caching.staging_changed),
+            (Entity, caching.entity_changed),
+            (Entity, spatial.entity_changed),
+            (LevelOfDetail, caching.lod_changed),
+            (MaterialImage, caching.material_image_changed),
+        ]:
+            post_save.connect(receiver, sender=model)
+            post_delete.connect(receiver, sender=model)
+        # stagings of a deleted entity are gone by post_delete
+        pre_delete.connect(caching.entity_changed, sender=Entity)
@@ -0,0 +1,117 @@
+"""
+Baking of scenes into a single model
+
+A baked scene merges all the stagings of a scene in one binary glTF,
+with a mesh for each staging color, so that A-Frame loads one file
+and draws a few meshes. Stagings of entities that can't be merged
+without changing their look (uploaded glTF models with their own
+materials, OBJ files with MTL materials) are left out and drawn one
+by one. The baked model is shown as long as the scene version is the
+one it was baked from.
+"""
+
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .geometry import (
+    READ_ERRORS,
+    baked_glb_dumps,
+    cad_to_gltf,
+    read_glb,
+    read_obj,
+    transform,
+)
+from .models import BakedScene, Scene
+
+
+def bake_scene(scene, skipped=None):
+    """
+    Merges stagings of scene, returns the BakedScene or None if there
+    is nothing to merge or if the scene changed in the meantime.
+    Stagings with malformed transforms or colors are left out with
+    their entity and appended to skipped.
+    """
+    scene.refresh_from_db(fields=["version"])
+    version = scene.version
+    meshes = {}
+    transforms = []
+    for staging in scene.staged_entities.select_related("entity").order_by("id"):
+        try:
+            transforms.append(
+                (staging, staging.matrix(), tuple(hex_to_rgb(staging.color)))
+            )
+        except ValueError:
+            # left to A-Frame, as the other stagings of the entity
+            meshes[staging.entity_id] = None
+            if skipped is not None:
+                skipped.append(staging)
+    groups = defaultdict(list)
+    for staging, matrix, color in transforms:
+        entity = staging.entity
+        if entity.id not in meshes:
+            meshes[entity.id] = entity_meshes(entity)
+        if meshes[entity.id] is None:
+            continue
+        groups[color].extend(
+            (transform(vertices, matrix), faces)
+            for vertices, faces in meshes[entity.id]
+        )
+    content = baked_glb_dumps(
+        [(list(color), group) for color, group in groups.items()],
+        precision=getattr(settings, "DJAFRAME_GLB_PRECISION", None),
+    )
+    if content is None:
+        return None
+    baked = BakedScene(
+        scene=scene,
+        version=version + 1,
+        entities=[id for id, pairs in meshes.items() if pairs is not None],
+    )
+    with transaction.atomic():
+        # baking is a change of the scene, that must not have changed
+        if not Scene.objects.filter(id=scene.id, version=version).update(
+            version=F("version") + 1, modified=timezone.now()
+        ):
+            return None
+        for previous in BakedScene.objects.filter(scene=scene):
+            transaction.on_commit(
+                partial(previous.model.storage.delete, previous.model.name)
+            )
+            previous.delete()
+        baked.model.save("baked.glb", ContentFile(content), save=False)
+        baked.save()
+    scene.version = baked.version
+    return baked
+
+
+def entity_meshes(entity):
+    """
+    Returns (vertices, triangles) pairs of entity in A-Frame axes, or
+    None if it can't be baked.
+    """
+    try:
+        if entity.gltf_model:
+            if not entity.gltf_model.name.lower().endswith(".glb"):
+                return None
+            with entity.gltf_model.open("rb") as f:
+                return read_glb(f)
+        if not entity.obj_model or entity.mtl_model:
+            return None
+        with entity.obj_model.open("rb") as f:
+            meshes = read_obj(f)
+    except READ_ERRORS:
+        # missing or malformed files are left to A-Frame
+        return None
+    if entity.switch:
+        meshes = [(cad_to_gltf(vertices), faces) for vertices, faces in meshes]
+    return meshes
+
+
+def hex_to_rgb(color):
+    return [c / 255 for c in bytes.fromhex(color.lstrip("#"))]
@@ -0,0 +1,184 @@
+"""
+Cache of the A-Frame markup of scenes
+
+Markup is cached per scene version: Scene.version is incremented
+whenever the scene, its stagings, staged entities or their material
+images change, so that the next request renders it again. It works
+with any cache backend: set DJAFRAME_CACHE to the alias to use.
+Instance groups, baked from stagings by the DXF import, are deleted
+as soon as one of their stagings changes. Baked scenes are shown only
+while they have the scene version, see baking.py.
+"""
+
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+SCENE_TEMPLATE = "djaframe/htmx/scene_aframe.html"
+
+_state = threading.local()
+
+
+def get_cache():
+    return caches[getattr(settings, "DJAFRAME_CACHE", "default")]
+
+
+def render_scene(scene):
+    """
+    Returns the A-Frame markup of scene, from the cache if it is up to
+    date, else rendered with stagings and entities in one query, or
+    with tiles loaded by the viewer if the scene is big.
+    """
+    cache = get_cache()
+    key = f"djaframe:scene:{scene.id}:{scene.version}"
+    markup = cache.get(key)
+    if markup is None:
+        markup = render_to_string(SCENE_TEMPLATE, scene_context(scene))
+        cache.set(key, markup, getattr(settings, "DJAFRAME_SCENE_CACHE_TIMEOUT", 3600))
+    return markup
+
+
+def scene_context(scene):
+    baked = scene_baked(scene)
+    tiled = getattr(settings, "DJAFRAME_TILED_SCENE_SIZE", None)
+    if not baked and tiled and scene.staged_entities.count() >= tiled:
+        # stagings are loaded tile by tile by the djaframe-tiles component
+        return {
+            "object": scene,
+            "sky_urls": scene.sky_urls(),
+            "tiles_url": reverse("djaframe:scene_tile_list", kwargs={"pk": scene.id}),
+        }
+    stagings, assets = scene_stagings(scene)
+    # baked entities are drawn by the baked model
+    drawn = set(baked.entities) if baked else set()
+    groups = [
+        group
+        for group in scene_instance_groups(scene, stagings)
+        if group.entity_id not in drawn
+    ]
+    # instanced entities are drawn once per group
+    drawn.update(group.entity_id for group in groups)
+    return {
+        "object": scene,
+        "sky_urls": scene.sky_urls(),
+        "stagings": [st for st in stagings if st.entity_id not in drawn],
+        "assets": [entity for entity in assets if entity.id not in drawn],
+        "instance_groups": groups,
+        "baked": baked,
+    }
+
+
+def scene_stagings(scene):
+    # stagings with their entities, and entities once each with
+    # their levels of detail as expected by the djaframe-lod component
+    stagings = list(scene.staged_entities.select_related("entity").order_by("id"))
+    assets = list({st.entity_id: st.entity for st in stagings}.values())
+    prefetch_related_objects(assets, "lods")
+    for entity in assets:
+        entity.lod_sources = ", ".join(
+            f"{lod.distance} #lod-file-{lod.id}" for lod in entity.lods.all()
+        )
+    return stagings, assets
+
+
+def scene_instance_groups(scene, stagings):
+    # groups with as many stagings as their entity has in the scene
+    counts = Counter(st.entity_id for st in stagings)
+    return [
+        group
+        for group in scene.instance_groups.all()
+        if counts[group.entity_id] == group.count
+    ]
+
+
+def scene_baked(scene):
+    # baked scene, if it is up to date
+    from .models import BakedScene
+
+    return BakedScene.objects.filter(scene=scene, version=scene.version).first()
+
+
+def touch_scenes(scene_ids):
+    # new version and modification time for scenes
+    from .models import Scene
+
+    Scene.objects.filter(id__in=set(scene_ids)).update(
+        version=F("version") + 1, modified=timezone.now()
+    )
+
+
+def entity_scene_ids(entity_id):
+    from .models import Staging
+
+    return Staging.objects.filter(entity_id=entity_id).values_list(
+        "scene_id", flat=True
+    )
+
+
+def delete_instance_groups(groups):
+    """
+    Deletes instance groups, their files are deleted once the
+    transaction commits.
+    """
+    for group in groups:
+        transaction.on_commit(partial(group.model.storage.delete, group.model.name))
+    groups.delete()
+
+
+@contextmanager
+def receivers_muted():
+    """
+    Receivers of this thread do nothing in the block, for bulk
+    changes that touch scenes once for all.
+    """
+    muted = getattr(_state, "muted", False)
+    _state.muted = True
+    try:
+        yield
+    finally:
+        _state.muted = muted
+
+
+def ignored(sender, origin=None, **kwargs):
+    # muted, or deleted along with a scene or entity whose receivers cover it
+    if getattr(_state, "muted", False):
+        return True
+    return origin is not None and getattr(origin, "model", type(origin)) is not sender
+
+
+def staging_changed(sender, instance, **kwargs):
+    from .models import InstanceGroup
+
+    if ignored(sender, **kwargs):
+        return
+    touch_scenes([instance.scene_id])
+    # instance transforms are baked in the file, stagings are drawn
+    # one by one until the next import
+    delete_instance_groups(
+        InstanceGroup.objects.filter(
+            scene_id=instance.scene_id, entity_id=instance.entity_id
+        )
+    )
+
+
+def entity_changed(sender, instance, **kwargs):
+    touch_scenes(entity_scene_ids(instance.id))
+
+
+def lod_changed(sender, instance, **kwargs):
+    if not ignored(sender, **kwargs):
+        touch_scenes(entity_scene_ids(instance.entity_id))
+
+
+def material_image_changed(sender, instance, **kwargs):
+    if not ignored(sender, **kwargs):
+        touch_scenes(entity_scene_ids(instance.entity_id))
@@ -0,0 +1,930 @@
+"""
+Mesh utilities working on NumPy arrays
+
+Nothing here imports Django: convert_meshes runs in import worker
+processes started with spawn, which have no settings.
+"""
+
+import hashlib
+import json
+import shutil
+import struct
+from bisect import bisect_right
+from io import BytesIO
+from itertools import chain
+from tempfile import SpooledTemporaryFile, TemporaryFile
+
+import numpy as np
+
+# Rows formatted in a single string operation when writing files.
+CHUNK_SIZE = 65536
+
+# Size above which generated files are moved from memory to disk.
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Same for the geometry streamed for each layer and block.
+STREAM_SPOOL_SIZE = 256 * 1024
+
+# glTF constants
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+COMPONENT_TYPES = {
+    np.dtype(np.int8): 5120,
+    np.dtype(np.uint8): 5121,
+    np.dtype(np.int16): 5122,
+    np.dtype(np.uint16): 5123,
+    np.dtype(np.uint32): 5125,
+    np.dtype(np.float32): 5126,
+}
+ACCESSOR_TYPES = {1: "SCALAR", 2: "VEC2", 3: "VEC3", 4: "VEC4", 16: "MAT4"}
+DTYPES = {value: key for key, value in COMPONENT_TYPES.items()}
+COMPONENT_COUNTS = {value: key for key, value in ACCESSOR_TYPES.items()}
+
+# Errors of missing or malformed model files
+READ_ERRORS = (OSError, ValueError, KeyError, IndexError, struct.error)
+
+# Floating point tolerance
+EPSILON = 1e-12
+
+# int16 steps from the center to the bounds of quantized positions
+QUANTIZED_STEPS = 32767
+
+
+def triangulate(faces):
+    """
+    Turns a list of polygons (sequences of vertex indices) into an (F, 3)
+    array of triangles. Polygons are fanned from their first vertex,
+    faces with less than three vertices are dropped.
+    """
+    lengths = np.fromiter(map(len, faces), dtype=np.int64, count=len(faces))
+    flat = np.fromiter(chain.from_iterable(faces), dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    triangles = []
+    for k in np.unique(lengths):
+        if k < 3:
+            continue
+        first = starts[lengths == k]
+        for j in range(1, k - 1):
+            triangles.append(
+                np.stack((flat[first], flat[first + j], flat[first + j + 1]), axis=1)
+            )
+    if not triangles:
+        return np.empty((0, 3), dtype=np.int64)
+    return np.concatenate(triangles)
+
+
+def merge_meshes(meshes):
+    """
+    Merges an iterable of (vertices, faces) pairs into a single mesh.
+    Faces of each mesh are offset by the number of vertices preceding
+    it with one vectorized add. Returns (V, 3) float64 vertices and
+    (F, 3) int64 zero based faces.
+    """
+    vertices = []
+    faces = []
+    for v, f in meshes:
+        vertices.append(np.asarray(v, dtype=np.float64).reshape(-1, 3))
+        faces.append(np.asarray(f, dtype=np.int64).reshape(-1, 3))
+    if not vertices:
+        return np.empty((0, 3), dtype=np.float64), np.empty((0, 3), dtype=np.int64)
+    counts = np.fromiter((len(v) for v in vertices), dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    face_counts = np.fromiter((len(f) for f in faces), dtype=np.int64)
+    merged = np.concatenate(faces) + np.repeat(offsets, face_counts)[:, np.newaxis]
+    return np.concatenate(vertices), merged
+
+
+def cluster_vertices(vertices, faces, divisions):
+    """
+    Simplifies a triangle mesh by vertex clustering: vertices are
+    snapped to a grid with divisions cells along the longest side of
+    the bounding box and merged into the mean of each cell. Collapsed
+    and duplicate triangles are dropped, returns vertices and faces.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if len(faces) == 0:
+        return vertices, faces
+    low = vertices.min(axis=0)
+    cell = (vertices.max(axis=0) - low).max() / divisions
+    if cell == 0:
+        return vertices, faces
+    keys = np.floor((vertices - low) / cell).astype(np.int64)
+    keys, cluster = np.unique(keys, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    count = np.bincount(cluster)
+    merged = np.stack(
+        [np.bincount(cluster, weights=vertices[:, i]) for i in range(3)], axis=1
+    )
+    merged /= count[:, None]
+    faces = cluster[faces]
+    faces = faces[
+        (faces[:, 0] != faces[:, 1])
+        & (faces[:, 1] != faces[:, 2])
+        & (faces[:, 2] != faces[:, 0])
+    ]
+    # same triangle with the same winding starts with its lowest index
+    first = faces.argmin(axis=1)
+    rolled = faces[np.arange(len(faces))[:, None], (first[:, None] + [0, 1, 2]) % 3]
+    rolled, index = np.unique(rolled, axis=0, return_index=True)
+    faces = rolled[np.argsort(index)]
+    # drop vertices no longer used
+    used, faces = np.unique(faces, return_inverse=True)
+    return merged[used], faces.reshape(-1, 3)
+
+
+def simplify(meshes, divisions):
+    # (vertices, polygons) pairs to a single clustered mesh
+    vertices, faces = merge_meshes((v, triangulate(f)) for v, f in meshes)
+    return [cluster_vertices(vertices, faces, divisions)]
+
+
+def mesh_digest(meshes, salt=""):
+    """
+    Returns the SHA-256 hex digest of (vertices, polygons) pairs,
+    salt tells apart different outputs of the same geometry.
+    """
+    h = hashlib.sha256(salt.encode())
+    for v, f in meshes:
+        update_digest(h, v, f)
+    return h.hexdigest()
+
+
+def update_digest(h, vertices, faces):
+    lengths = np.fromiter(map(len, faces), dtype=np.int64, count=len(faces))
+    flat = np.fromiter(chain.from_iterable(faces), dtype=np.int64)
+    for array in (np.asarray(vertices, dtype=np.float64), lengths, flat):
+        h.update(np.int64(array.size).tobytes())
+        h.update(np.ascontiguousarray(array).tobytes())
+
+
+def write_obj(f, vertices, faces):
+    """
+    Writes vertices and zero based faces to binary file f in OBJ format,
+    formatting CHUNK_SIZE rows at a time.
+    """
+    for i in range(0, len(vertices), CHUNK_SIZE):
+        chunk = vertices[i : i + CHUNK_SIZE].round(6)
+        f.write(
+            (("v %r %r %r\n" * len(chunk)) % tuple(chunk.ravel().tolist())).encode()
+        )
+    for i in range(0, len(faces), CHUNK_SIZE):
+        chunk = faces[i : i + CHUNK_SIZE] + 1
+        f.write(
+            (("f %d %d %d\n" * len(chunk)) % tuple(chunk.ravel().tolist())).encode()
+        )
+
+
+def obj_dumps(meshes):
+    """
+    Merges (vertices, polygons) pairs and returns them as OBJ bytes,
+    or None if there are no faces. It depends on NumPy only, so that
+    it can run in worker processes.
+    """
+    vertices, faces = merge_meshes((v, triangulate(f)) for v, f in meshes)
+    if len(faces) == 0:
+        return None
+    f = BytesIO()
+    f.write(b"# Generated by django-a-frame\n")
+    write_obj(f, vertices, faces)
+    return f.getvalue()
+
+
+def cad_to_gltf(vertices):
+    """
+    Rotates CAD coordinates (Z up) to glTF coordinates (Y up),
+    same as the -90 degrees rotation of switched entities.
+    """
+    return np.stack((vertices[:, 0], vertices[:, 2], -vertices[:, 1]), axis=1)
+
+
+class GLTFBuilder:
+    """
+    Collects glTF JSON and a single binary buffer, dumps them as GLB.
+    Binary data comes from NumPy arrays, no per vertex Python loops.
+    """
+
+    def __init__(self):
+        self.gltf = {
+            "asset": {"version": "2.0", "generator": "django-a-frame"},
+            "scene": 0,
+            "scenes": [{"nodes": []}],
+            "nodes": [],
+            "meshes": [],
+            "materials": [],
+            "accessors": [],
+            "bufferViews": [],
+            "buffers": [],
+            "extensionsUsed": [],
+            "extensionsRequired": [],
+        }
+        self.buffer = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+b")
+
+    def add_buffer_view(self, data, target=None, stride=None):
+        # data is an array or an iterable of array chunks,
+        # every view starts 4 bytes aligned
+        if isinstance(data, np.ndarray):
+            data = [data]
+        self.buffer.write(b"\0" * (-self.buffer.tell() % 4))
+        view = {"buffer": 0, "byteOffset": self.buffer.tell()}
+        for chunk in data:
+            self.buffer.write(np.ascontiguousarray(chunk).tobytes())
+        view["byteLength"] = self.buffer.tell() - view["byteOffset"]
+        if stride:
+            view["byteStride"] = stride
+        if target:
+            view["target"] = target
+        self.gltf["bufferViews"].append(view)
+        return len(self.gltf["bufferViews"]) - 1
+
+    def add_accessor(self, data, target=None, normalized=False, bounds=False):
+        # data is (count, components) or (count, ) for scalars
+        return self.add_view_accessor(
+            self.add_buffer_view(data, target),
+            data.dtype,
+            len(data),
+            data[0].size,
+            normalized=normalized,
+            bounds=(data.min(axis=0), data.max(axis=0)) if bounds else None,
+        )
+
+    def add_view_accessor(
+        self, view, dtype, count, components, normalized=False, bounds=None
+    ):
+        accessor = {
+            "bufferView": view,
+            "componentType": COMPONENT_TYPES[np.dtype(dtype)],
+            "count": int(count),
+            "type": ACCESSOR_TYPES[components],
+        }
+        if normalized:
+            accessor["normalized"] = True
+        if bounds is not None:
+            accessor["min"] = np.asarray(bounds[0]).reshape(-1).tolist()
+            accessor["max"] = np.asarray(bounds[1]).reshape(-1).tolist()
+        self.gltf["accessors"].append(accessor)
+        return len(self.gltf["accessors"]) - 1
+
+    def add_indices(self, faces, vertex_count):
+        dtype = np.uint16 if vertex_count <= 65535 else np.uint32
+        return self.add_accessor(
+            faces.astype(dtype).reshape(-1), target=ELEMENT_ARRAY_BUFFER
+        )
+
+    def add_material(self, color=(1.0, 1.0, 1.0, 1.0), name="djaframe"):
+        # default name lets the djaframe-color A-Frame component tint it
+        self.gltf["materials"].append(
+            {
+                "name": name,
+                "pbrMetallicRoughness": {
+                    "baseColorFactor": list(color),
+                    "metallicFactor": 0.0,
+                    "roughnessFactor": 0.5,
+                },
+            }
+        )
+        return len(self.gltf["materials"]) - 1
+
+    def add_mesh(self, attributes, indices, material):
+        self.gltf["meshes"].append(
+            {
+                "primitives": [
+                    {"attributes": attributes, "indices": indices, "material": material}
+                ]
+            }
+        )
+        return len(self.gltf["meshes"]) - 1
+
+    def require_extension(self, name):
+        if name not in self.gltf["extensionsRequired"]:
+            self.gltf["extensionsUsed"].append(name)
+            self.gltf["extensionsRequired"].append(name)
+
+    def add_positions(self, chunks, count, low, high, precision=None):
+        """
+        Adds POSITION accessor of count vertices in glTF axes, given as
+        chunks, with bounds low and high. Returns the accessor and the
+        node transform restoring them. Positions are stored as float32
+        relative to their center, or as int16 (KHR_mesh_quantization)
+        if int16 steps over the bounds are within precision.
+        """
+        center = (low + high) / 2
+        half = (high - low) / 2
+        if precision is None or half.max() / QUANTIZED_STEPS > precision:
+            dtype, scale = np.float32, None
+        else:
+            dtype, scale = np.int16, np.where(half > 0, half / QUANTIZED_STEPS, 1)
+            self.require_extension("KHR_mesh_quantization")
+
+        def encode(vertices):
+            if scale is None:
+                return (vertices - center).astype(np.float32)
+            # vertex attributes are 4 bytes aligned, int16 are padded
+            quantized = np.zeros((len(vertices), 4), dtype=np.int16)
+            quantized[:, :3] = np.rint((vertices - center) / scale)
+            return quantized
+
+        accessor = self.add_view_accessor(
+            self.add_buffer_view(
+                map(encode, chunks),
+                target=ARRAY_BUFFER,
+                stride=None if scale is None else 8,
+            ),
+            dtype,
+            count,
+            3,
+            bounds=(encode(low[None])[0, :3], encode(high[None])[0, :3]),
+        )
+        node = {"translation": center.tolist()}
+        if scale is not None:
+            node["scale"] = scale.tolist()
+        return accessor, node
+
+    def add_instances(self, mesh, matrices, colors, center):
+        """
+        Adds a node drawing mesh once per (4, 4) CAD block transform
+        (EXT_mesh_gpu_instancing), with sRGB colors. Mesh positions are
+        relative to center, in glTF axes.
+        """
+        translation, rotation, scale = instance_trs(matrices, center)
+        attributes = {
+            "TRANSLATION": self.add_accessor(translation.astype(np.float32)),
+            "ROTATION": self.add_accessor(rotation.astype(np.float32)),
+            "SCALE": self.add_accessor(scale.astype(np.float32)),
+            # instance colors are linear
+            "_COLOR_0": self.add_accessor(srgb_to_linear(colors).astype(np.float32)),
+        }
+        self.require_extension("EXT_mesh_gpu_instancing")
+        return self.add_node(
+            mesh=mesh,
+            extensions={"EXT_mesh_gpu_instancing": {"attributes": attributes}},
+        )
+
+    def add_node(self, **node):
+        self.gltf["nodes"].append(node)
+        self.gltf["scenes"][0]["nodes"].append(len(self.gltf["nodes"]) - 1)
+        return len(self.gltf["nodes"]) - 1
+
+    def dump(self, f):
+        # writes GLB to binary file f, the buffer is copied in chunks
+        self.buffer.write(b"\0" * (-self.buffer.tell() % 4))
+        size = self.buffer.tell()
+        self.gltf["buffers"] = [{"byteLength": size}]
+        gltf = {key: value for key, value in self.gltf.items() if value != []}
+        content = json.dumps(gltf, separators=(",", ":")).encode()
+        content += b" " * (-len(content) % 4)
+        f.write(struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(content) + 8 + size))
+        f.write(struct.pack("<I4s", len(content), b"JSON"))
+        f.write(content)
+        f.write(struct.pack("<I4s", size, b"BIN\0"))
+        self.buffer.seek(0)
+        shutil.copyfileobj(self.buffer, f)
+        self.buffer.close()
+
+    def dumps(self):
+        f = BytesIO()
+        self.dump(f)
+        return f.getvalue()
+
+
+def instance_trs(matrices, center):
+    """
+    Decomposes (N, 4, 4) CAD block transforms, with translation in the
+    last row as ezdxf Matrix44, into glTF translations, rotation
+    quaternions (x, y, z, w) and scales of a mesh whose positions are
+    relative to center, in glTF axes. Mirrored blocks get a negative
+    X scale.
+    """
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    # row vectors: v_gltf = v_cad @ axes, see cad_to_gltf
+    axes = np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]], dtype=np.float64)
+    linear = axes.T @ matrices[:, :3, :3] @ axes
+    translation = center @ linear + matrices[:, 3, :3] @ axes
+    # column vectors: linear part is rotation @ diag(scale)
+    A = linear.transpose(0, 2, 1)
+    scale = np.linalg.norm(A, axis=1)
+    R = A / np.where(scale == 0, 1, scale)[:, None, :]
+    mirrored = np.linalg.det(R) < 0
+    scale[mirrored, 0] *= -1
+    R[mirrored, :, 0] *= -1
+    return translation, rotation_matrices_to_quaternions(R), scale
+
+
+def rotation_matrices_to_quaternions(R):
+    # (N, 3, 3) rotation matrices to (N, 4) quaternions (x, y, z, w),
+    # computed from the largest component for numerical stability
+    m = np.asarray(R, dtype=np.float64)
+    m00, m01, m02 = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+    m10, m11, m12 = m[:, 1, 0], m[:, 1, 1], m[:, 1, 2]
+    m20, m21, m22 = m[:, 2, 0], m[:, 2, 1], m[:, 2, 2]
+    squares = np.stack(
+        [
+            1 + m00 - m11 - m22,
+            1 - m00 + m11 - m22,
+            1 - m00 - m11 + m22,
+            1 + m00 + m11 + m22,
+        ]
+    )
+    case = squares.argmax(axis=0)
+    s = 2 * np.sqrt(np.maximum(squares.max(axis=0), EPSILON))
+    candidates = np.stack(
+        [
+            [s / 4, (m01 + m10) / s, (m02 + m20) / s, (m21 - m12) / s],
+            [(m01 + m10) / s, s / 4, (m12 + m21) / s, (m02 - m20) / s],
+            [(m02 + m20) / s, (m12 + m21) / s, s / 4, (m10 - m01) / s],
+            [(m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s, s / 4],
+        ]
+    )
+    return candidates[case, :, np.arange(len(m))]
+
+
+def srgb_to_linear(colors):
+    # (N, 3) sRGB colors in [0, 1]
+    colors = np.asarray(colors, dtype=np.float64)
+    return np.where(
+        colors <= 0.04045, colors / 12.92, ((colors + 0.055) / 1.055) ** 2.4
+    )
+
+
+def instanced_glb_dumps(meshes, matrices, colors):
+    """
+    Merges (vertices, polygons) pairs and returns them as binary glTF
+    drawn once per block transform, see GLTFBuilder.add_instances,
+    or None if there are no faces.
+    """
+    vertices, faces = merge_meshes((v, triangulate(f)) for v, f in meshes)
+    if len(faces) == 0:
+        return None
+    vertices = cad_to_gltf(vertices)
+    builder = GLTFBuilder()
+    position, node = builder.add_positions(
+        [vertices], len(vertices), vertices.min(axis=0), vertices.max(axis=0)
+    )
+    mesh = builder.add_mesh(
+        {"POSITION": position},
+        builder.add_indices(faces, len(vertices)),
+        builder.add_material(),
+    )
+    builder.add_instances(mesh, matrices, colors, np.array(node["translation"]))
+    return builder.dumps()
+
+
+def glb_dumps(meshes, precision=None):
+    """
+    Merges (vertices, polygons) pairs and returns them as binary glTF,
+    or None if there are no faces. Vertices are rotated to Y up and
+    stored relative to their center, which goes to the node
+    translation in full precision, see GLTFBuilder.add_positions.
+    """
+    vertices, faces = merge_meshes((v, triangulate(f)) for v, f in meshes)
+    if len(faces) == 0:
+        return None
+    vertices = cad_to_gltf(vertices)
+    builder = GLTFBuilder()
+    position, node = builder.add_positions(
+        [vertices],
+        len(vertices),
+        vertices.min(axis=0),
+        vertices.max(axis=0),
+        precision,
+    )
+    mesh = builder.add_mesh(
+        {"POSITION": position},
+        builder.add_indices(faces, len(vertices)),
+        builder.add_material(),
+    )
+    builder.add_node(mesh=mesh, **node)
+    return builder.dumps()
+
+
+def read_obj(f):
+    """
+    Reads vertices and faces from binary file f in OBJ format, returns
+    a list with one (vertices, triangles) pair. Texture coordinates,
+    normals and materials are ignored.
+    """
+    vertices = []
+    faces = []
+    for line in f:
+        if line.startswith(b"v "):
+            vertices.append(line.split()[1:4])
+        elif line.startswith(b"f "):
+            # indices are one based, negative ones count back
+            count = len(vertices)
+            faces.append(
+                [
+                    i - 1 if i > 0 else count + i
+                    for i in (int(token.split(b"/")[0]) for token in line.split()[1:])
+                ]
+            )
+    if not faces:
+        return []
+    return [(np.array(vertices, dtype=np.float64), triangulate(faces))]
+
+
+def read_obj_bounds(f):
+    """
+    Returns (low, high) bounds of the vertices of binary OBJ file f, or
+    None if it has none. Faces and anything else are skipped.
+    """
+    lines = [line[2:] for line in f if line.startswith(b"v ")]
+    if not lines:
+        return None
+    vertices = np.loadtxt(lines, usecols=(0, 1, 2), ndmin=2)
+    return vertices.min(axis=0), vertices.max(axis=0)
+
+
+def read_glb(f):
+    """
+    Reads the triangles of binary glTF file f, returns a list of
+    (vertices, triangles) pairs with node transforms applied, or None
+    if the file has anything a plain colored mesh can't reproduce
+    (textures, materials other than "djaframe", animations,
+    instancing, external buffers).
+    """
+    gltf = read_gltf_json(f)
+    header = f.read(8)
+    binary = f.read(struct.unpack("<I4s", header)[0]) if len(header) == 8 else b""
+    if (
+        set(gltf.get("extensionsRequired", [])) - {"KHR_mesh_quantization"}
+        or any("uri" in buffer for buffer in gltf.get("buffers", []))
+        or any(
+            material.get("name") != "djaframe" for material in gltf.get("materials", [])
+        )
+        or gltf.get("animations")
+        or gltf.get("skins")
+    ):
+        return None
+
+    def read_accessor(index):
+        accessor = gltf["accessors"][index]
+        view = gltf["bufferViews"][accessor["bufferView"]]
+        dtype = np.dtype(DTYPES[accessor["componentType"]]).newbyteorder("<")
+        components = COMPONENT_COUNTS[accessor["type"]]
+        data = np.ndarray(
+            (accessor["count"], components),
+            dtype,
+            binary,
+            view.get("byteOffset", 0) + accessor.get("byteOffset", 0),
+            (view.get("byteStride", dtype.itemsize * components), dtype.itemsize),
+        )
+        return dequantize(data, accessor)
+
+    meshes = []
+    for node, matrix in scene_nodes(gltf):
+        if "mesh" not in node:
+            continue
+        if "extensions" in node:
+            return None
+        for primitive in gltf["meshes"][node["mesh"]]["primitives"]:
+            if (
+                primitive.get("mode", 4) != 4
+                or "material" not in primitive
+                or "targets" in primitive
+                or any(
+                    "sparse" in gltf["accessors"][i]
+                    for i in primitive["attributes"].values()
+                )
+            ):
+                return None
+            vertices = transform(
+                read_accessor(primitive["attributes"]["POSITION"]), matrix
+            )
+            if "indices" in primitive:
+                faces = read_accessor(primitive["indices"]).reshape(-1, 3)
+            else:
+                faces = np.arange(len(vertices)).reshape(-1, 3)
+            meshes.append((vertices, faces.astype(np.int64)))
+    return meshes
+
+
+def read_gltf_json(f):
+    # JSON of glTF file f, binary files are left at their binary chunk
+    magic = f.read(4)
+    if magic != b"glTF":
+        return json.loads(magic + f.read())
+    f.read(8)
+    json_length, _kind = struct.unpack("<I4s", f.read(8))
+    return json.loads(f.read(json_length))
+
+
+def scene_nodes(gltf):
+    # (node, transform) pairs of the default scene, parents first
+    scene = gltf.get("scenes", [{"nodes": []}])[gltf.get("scene", 0)]
+    stack = [(index, np.eye(4)) for index in scene.get("nodes", [])]
+    while stack:
+        index, parent = stack.pop()
+        node = gltf["nodes"][index]
+        matrix = parent @ node_matrix(node)
+        yield node, matrix
+        stack.extend((child, matrix) for child in node.get("children", []))
+
+
+def dequantize(data, accessor):
+    # normalized integers to floats in [-1, 1] or [0, 1]
+    if not accessor.get("normalized"):
+        return data
+    dtype = DTYPES[accessor["componentType"]]
+    return np.maximum(np.asarray(data) / np.iinfo(dtype).max, -1)
+
+
+def gltf_bounds(gltf):
+    """
+    Returns (low, high) bounds of the meshes of glTF JSON with node
+    transforms applied, from the POSITION bounds that glTF requires,
+    so binary data is not read. None if there are no meshes.
+    """
+    corners = []
+    for node, matrix in scene_nodes(gltf):
+        if "mesh" not in node:
+            continue
+        for primitive in gltf["meshes"][node["mesh"]]["primitives"]:
+            accessor = gltf["accessors"][primitive["attributes"]["POSITION"]]
+            low, high = (
+                dequantize(np.array(accessor[key], dtype=np.float64), accessor)
+                for key in ("min", "max")
+            )
+            corners.append(transform(box_corners(low, high), matrix))
+    if not corners:
+        return None
+    corners = np.concatenate(corners)
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def box_corners(low, high):
+    # (8, 3) corners of the box from low to high
+    grid = np.meshgrid(*zip(low, high), indexing="ij")
+    return np.stack(grid, axis=-1).reshape(-1, 3)
+
+
+def cad_box_to_gltf(low, high):
+    # (low, high) bounds in glTF axes of the CAD box from low to high
+    corners = cad_to_gltf(box_corners(low, high))
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def transform_boxes(low, high, matrices):
+    """
+    Returns (low, high) bounds of (N, 3) boxes from low to high,
+    transformed by (N, 4, 4) matrices for column vectors.
+    """
+    mask = box_corners((False,) * 3, (True,) * 3)
+    corners = np.where(mask, high[:, None, :], low[:, None, :])
+    corners = corners @ matrices[:, :3, :3].transpose(0, 2, 1)
+    corners += matrices[:, None, :3, 3]
+    return corners.min(axis=1), corners.max(axis=1)
+
+
+def node_matrix(node):
+    # (4, 4) glTF node transform, for column vectors
+    if "matrix" in node:
+        return np.array(node["matrix"], dtype=np.float64).reshape(4, 4).T
+    matrix = np.eye(4)
+    x, y, z, w = node.get("rotation", (0, 0, 0, 1))
+    matrix[:3, :3] = np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+        ]
+    ) * np.asarray(node.get("scale", (1, 1, 1)), dtype=np.float64)
+    matrix[:3, 3] = node.get("translation", (0, 0, 0))
+    return matrix
+
+
+def aframe_matrix(position, rotation, scale):
+    """
+    Returns the (4, 4) transform of an A-Frame entity, for column
+    vectors, given position, rotation in degrees and scale as three
+    floats. A-Frame rotates in Y, X, Z order (yaw, pitch, roll).
+    """
+    x, y, z = np.radians(rotation)
+    rx = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+    ry = np.array([[np.cos(y), 0, np.sin(y)], [0, 1, 0], [-np.sin(y), 0, np.cos(y)]])
+    rz = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = ry @ rx @ rz * np.asarray(scale, dtype=np.float64)
+    matrix[:3, 3] = position
+    return matrix
+
+
+def transform(vertices, matrix):
+    # (N, 3) vertices by a (4, 4) transform for column vectors
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    return vertices @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def baked_glb_dumps(groups, precision=None):
+    """
+    Returns binary glTF with one mesh for each (color, meshes) pair in
+    groups, where color is sRGB in [0, 1] and meshes are (vertices,
+    triangles) pairs already in glTF axes, or None if there are no
+    faces. Materials are not named "djaframe", so they keep their color.
+    """
+    builder = GLTFBuilder()
+    for color, meshes in groups:
+        vertices, faces = merge_meshes(meshes)
+        if len(faces) == 0:
+            continue
+        position, node = builder.add_positions(
+            [vertices],
+            len(vertices),
+            vertices.min(axis=0),
+            vertices.max(axis=0),
+            precision,
+        )
+        material = builder.add_material(
+            (*srgb_to_linear([color])[0].tolist(), 1.0), name="baked"
+        )
+        mesh = builder.add_mesh(
+            {"POSITION": position},
+            builder.add_indices(faces, len(vertices)),
+            material,
+        )
+        builder.add_node(mesh=mesh, **node)
+    if not builder.gltf["meshes"]:
+        return None
+    return builder.dumps()
+
+
+def convert_meshes(data, dumps, lod_levels):
+    """
+    Returns file content of (vertices, polygons) pairs written by
+    dumps, or None if there are no faces, and (level, distance,
+    triangles, content) of levels of detail with fewer triangles than
+    the level before. It runs in worker processes too.
+    """
+    content = dumps(data)
+    if content is None:
+        return None, []
+    lods = []
+    triangles = sum(len(triangulate(f)) for v, f in data)
+    for level, (divisions, distance) in enumerate(lod_levels, 1):
+        simplified = simplify(data, divisions)
+        count = len(simplified[0][1])
+        if 0 < count < triangles:
+            lods.append((level, distance, count, dumps(simplified)))
+            triangles = count
+    return content, lods
+
+
+class SharedSpool:
+    """
+    Anonymous temporary file shared by many files written once and then
+    read back (see SpoolSegments): memory and file descriptors don't
+    grow with their number.
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+
+    def open(self):
+        return SpoolSegments(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+class SpoolSegments:
+    """
+    File whose writes are appended to a shared temporary file, read
+    back as the sequence of segments it wrote. Consecutive writes
+    make a single segment.
+    """
+
+    closed = False
+
+    def __init__(self, file):
+        self.file = file
+        self.segments = []
+        self.starts = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        self.file.write(data)
+        if self.segments and sum(self.segments[-1]) == offset:
+            self.segments[-1] = (self.segments[-1][0], self.segments[-1][1] + len(data))
+        else:
+            self.segments.append((offset, len(data)))
+            self.starts.append(self.size)
+        self.size += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        self.position = (0, self.position, self.size)[whence] + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        data = bytearray()
+        while size > 0 and self.position < self.size:
+            i = bisect_right(self.starts, self.position) - 1
+            offset, length = self.segments[i]
+            skip = self.position - self.starts[i]
+            self.file.seek(offset + skip)
+            chunk = self.file.read(min(size, length - skip))
+            data += chunk
+            self.position += len(chunk)
+            size -= len(chunk)
+        return bytes(data)
+
+    def close(self):
+        # the shared file is closed by its SharedSpool
+        pass
+
+
+class MeshWriter:
+    """
+    Accumulates (vertices, polygons) pairs one at a time on spooled
+    temporary files, or on a SharedSpool, so that memory stays bounded,
+    then dumps them as OBJ or GLB, with the same output and digest of
+    obj_dumps, glb_dumps and mesh_digest.
+    """
+
+    def __init__(self, salt="", spool=None):
+        if spool is None:
+            self.vertices = SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE, mode="w+b")
+            self.faces = SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE, mode="w+b")
+        else:
+            self.vertices = spool.open()
+            self.faces = spool.open()
+        self.vertex_count = 0
+        self.face_count = 0
+        self.min = np.full(3, np.inf)
+        self.max = np.full(3, -np.inf)
+        self.digest = hashlib.sha256(salt.encode())
+
+    def add(self, vertices, faces):
+        update_digest(self.digest, vertices, faces)
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        faces = triangulate(faces) + self.vertex_count
+        if len(vertices):
+            self.min = np.minimum(self.min, vertices.min(axis=0))
+            self.max = np.maximum(self.max, vertices.max(axis=0))
+        self.vertices.write(vertices.tobytes())
+        self.faces.write(faces.tobytes())
+        self.vertex_count += len(vertices)
+        self.face_count += len(faces)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def chunks(self, f, dtype):
+        # reads back (n, 3) arrays of CHUNK_SIZE rows
+        f.seek(0)
+        size = CHUNK_SIZE * 3 * np.dtype(dtype).itemsize
+        while data := f.read(size):
+            yield np.frombuffer(data, dtype=dtype).reshape(-1, 3)
+
+    def write_obj(self, f):
+        f.write(b"# Generated by django-a-frame\n")
+        for chunk in self.chunks(self.vertices, np.float64):
+            write_obj(f, chunk, np.empty((0, 3), dtype=np.int64))
+        for chunk in self.chunks(self.faces, np.int64):
+            write_obj(f, np.empty((0, 3)), chunk)
+
+    def write_glb(self, f, precision=None):
+        builder, mesh, node = self.build_glb(precision)
+        builder.add_node(mesh=mesh, **node)
+        builder.dump(f)
+
+    def write_instanced_glb(self, f, matrices, colors):
+        builder, mesh, node = self.build_glb()
+        builder.add_instances(mesh, matrices, colors, np.array(node["translation"]))
+        builder.dump(f)
+
+    def build_glb(self, precision=None):
+        # bounds of vertices rotated to Y up, see cad_to_gltf
+        low = np.array((self.min[0], self.min[2], -self.max[1]))
+        high = np.array((self.max[0], self.max[2], -self.min[1]))
+        builder = GLTFBuilder()
+        position, node = builder.add_positions(
+            map(cad_to_gltf, self.chunks(self.vertices, np.float64)),
+            self.vertex_count,
+            low,
+            high,
+            precision,
+        )
+        dtype = np.uint16 if self.vertex_count <= 65535 else np.uint32
+        indices = builder.add_view_accessor(
+            builder.add_buffer_view(
+                (chunk.astype(dtype) for chunk in self.chunks(self.faces, np.int64)),
+                target=ELEMENT_ARRAY_BUFFER,
+            ),
+            dtype,
+            self.face_count * 3,
+            1,
+        )
+        mesh = builder.add_mesh({"POSITION": position}, indices, builder.add_material())
+        return builder, mesh, node
+
+    def close(self):
+        self.vertices.close()
+        self.faces.close()
@@ -0,0 +1,586 @@
+"""
+DXF import: layers and blocks with meshes become entities,
+layers and block insertions become stagings of the scene
+"""
+
+import json
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from tempfile import SpooledTemporaryFile
+
+import ezdxf
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.db import connection, transaction
+from ezdxf.addons.iterdxf import opendxf
+
+from .caching import delete_instance_groups, receivers_muted, touch_scenes
+from .geometry import (
+    SPOOL_MAX_SIZE,
+    MeshWriter,
+    SharedSpool,
+    cad_box_to_gltf,
+    convert_meshes,
+    glb_dumps,
+    instanced_glb_dumps,
+    mesh_digest,
+    obj_dumps,
+)
+from .models import (
+    Entity,
+    InstanceGroup,
+    LevelOfDetail,
+    Staging,
+    cad2hex,
+    rotation_matrices_to_euler_angles_zyx,
+)
+
+# Layer, 16 floats of block transform, scales and attribs of an INSERT.
+InsertRecord = namedtuple("InsertRecord", ["layer", "matrix", "scale", "attribs"])
+
+# Writers and file names of DJAFRAME_DXF_FORMAT choices.
+FORMATS = {
+    "obj": (obj_dumps, "object.obj"),
+    "glb": (glb_dumps, "object.glb"),
+}
+
+
+class DXFImporter:
+    """
+    Reads the scene DXF and collects entities and stagings without
+    touching the database, then writes them with bulk_create in batches
+    of DJAFRAME_IMPORT_BATCH_SIZE inside a single transaction.
+    """
+
+    def __init__(self, scene, progress=None, batch_size=None):
+        self.scene = scene
+        # progress, if provided, is called with done and total steps
+        self.progress = progress
+        self.batch_size = batch_size or getattr(
+            settings, "DJAFRAME_IMPORT_BATCH_SIZE", 500
+        )
+        self.format = getattr(settings, "DJAFRAME_DXF_FORMAT", "obj")
+        if self.format not in FORMATS:
+            raise ImproperlyConfigured(
+                f"DJAFRAME_DXF_FORMAT must be one of {', '.join(FORMATS)}"
+            )
+        self.dumps = FORMATS[self.format][0]
+        # entities are reused from other imports with the same output
+        self.salt = self.format
+        # quantized positions of GLB within precision, in meters
+        self.precision = getattr(settings, "DJAFRAME_GLB_PRECISION", None)
+        if self.format == "glb" and self.precision:
+            self.dumps = partial(glb_dumps, precision=self.precision)
+            self.salt += f" precision {self.precision}"
+        # (grid divisions, distance) of each level of detail
+        self.lod_levels = [tuple(lod) for lod in getattr(settings, "DJAFRAME_LODS", [])]
+        # blocks inserted at least this number of times are instanced
+        self.instancing_min = getattr(settings, "DJAFRAME_INSTANCING_MIN", None)
+        # pairs of unsaved entity, level of detail or instance group
+        # and its generated file
+        self.entities = []
+        self.lods = []
+        self.instance_groups = []
+        # entity, geometry source and insertion records by content hash
+        self.instances = {}
+        self.stagings = []
+        self.new_stagings = []
+        self.layer_dict = {}
+
+    def run(self, replace=False):
+        # replace updates stagings of a previous import of the scene
+        try:
+            if self.scene.dxf:
+                self.read(self.scene.dxf.path)
+            self.write(replace)
+        finally:
+            for obj, file in self.entities + self.lods + self.instance_groups:
+                file.close()
+
+    def read(self, path):
+        self.extract(ezdxf.readfile(path))
+
+    def extract(self, doc):
+        self.layer_dict = layer_colors(doc.layers)
+        # group model space entities in one scan
+        meshes, inserts = index_modelspace(doc.modelspace())
+        # layers and blocks with meshes are converted independently
+        items = []
+        for name in self.layer_dict:
+            if meshes.get(name):
+                items.append(("Layer", name, mesh_data(meshes[name])))
+        for block in doc.blocks:
+            if block.name in [
+                "*Model_Space",
+            ]:
+                continue
+            block_meshes = block.query("MESH")
+            if block_meshes:
+                items.append(("Block", block.name, mesh_data(block_meshes)))
+        salt = self.salt
+        if self.lod_levels:
+            salt += f" lods {self.lod_levels}"
+        digests = [mesh_digest(data, salt) for kind, name, data in items]
+        self.collect(items, digests, inserts)
+
+    def collect(self, items, digests, inserts):
+        """
+        Adds entities and stagings of (kind, name, source) items.
+        Identical geometry is converted and stored once, reusing
+        entities from previous imports with the same content hash.
+        Sources are turned into files by convert.
+        """
+        entities = {
+            e.content_hash: e for e in Entity.objects.filter(content_hash__in=digests)
+        }
+        todo = []
+        queued = set(entities)
+        for (kind, name, data), digest in zip(items, digests):
+            if digest not in queued:
+                queued.add(digest)
+                todo.append(data)
+        results = self.convert(todo)
+        for done, ((kind, name, data), digest) in enumerate(zip(items, digests), 1):
+            self.report(done, len(items))
+            if digest not in entities:
+                file, lods = next(results)
+                # no faces to write
+                if file is None:
+                    entities[digest] = None
+                else:
+                    entities[digest] = self.add_entity(
+                        f"{kind} {name}", file, digest, lods, self.bounds(data)
+                    )
+            entity = entities[digest]
+            if entity is None:
+                continue
+            if kind == "Layer":
+                self.add_staging(
+                    entity,
+                    color=self.layer_dict[name],
+                    data={"Layer": name},
+                )
+            else:
+                # we look for insertions of the block
+                records = self.add_insertions(entity, name, inserts.get(name, []))
+                if self.instancing_min:
+                    group = self.instances.setdefault(digest, (entity, data, []))
+                    group[2].extend(records)
+        for entity, source, records in self.instances.values():
+            if len(records) >= self.instancing_min:
+                self.add_instance_group(entity, source, records)
+
+    def add_instance_group(self, entity, source, records):
+        matrices = np.array([rec.matrix for rec in records], dtype=np.float64)
+        colors = np.array(
+            [list(bytes.fromhex(self.layer_dict[rec.layer][1:])) for rec in records],
+            dtype=np.uint8,
+        )
+        file = self.dump_instances(source, matrices, colors / 255)
+        if file is not None:
+            group = InstanceGroup(scene=self.scene, entity=entity, count=len(records))
+            self.instance_groups.append((group, file))
+
+    def dump_instances(self, data, matrices, colors):
+        content = instanced_glb_dumps(data, matrices, colors)
+        return None if content is None else spool(content)
+
+    def report(self, done, total):
+        if self.progress:
+            self.progress(done, total)
+
+    def convert(self, data):
+        # yields files and levels of detail in order, converted on a
+        # process pool if DJAFRAME_IMPORT_PROCESSES is set, else one
+        # after another
+        dumps = partial(convert_meshes, dumps=self.dumps, lod_levels=self.lod_levels)
+        processes = getattr(settings, "DJAFRAME_IMPORT_PROCESSES", 0)
+        if not processes:
+            yield from map(spool_converted, map(dumps, data))
+            return
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=get_context("spawn")
+        ) as executor:
+            yield from map(spool_converted, executor.map(dumps, data))
+
+    def add_insertions(self, entity, block_name, inserts):
+        # inserts are INSERT entities or records made by insert_record
+        records = [
+            ins if isinstance(ins, InsertRecord) else insert_record(ins)
+            for ins in inserts
+        ]
+        if not records:
+            return records
+        # block reference transforms as an (N, 4, 4) stack
+        M = np.array([rec.matrix for rec in records], dtype=np.float64)
+        M = M.reshape(-1, 4, 4)
+        # for 3D rotated insertions we need origin of local coords...
+        origins = M[:, 3, :3]
+        # ...and unit vectors of local coords, scale is staged apart...
+        R = M[:, :3, :3]
+        R = R / np.linalg.norm(R, axis=2, keepdims=True)
+        # ...to extract 3D rotation of insertions
+        yaw, roll, pitch, gimbal_lock = rotation_matrices_to_euler_angles_zyx(R)
+        rotations = np.degrees(np.stack((-pitch, -yaw, roll), axis=1))
+        for rec, origin, rotation in zip(records, origins.tolist(), rotations.tolist()):
+            xscale, yscale, zscale = rec.scale
+            self.add_staging(
+                entity,
+                color=self.layer_dict[rec.layer],
+                position=f"{origin[0]} {origin[2]} {-origin[1]}",
+                rotation="{} {} {}".format(*rotation),
+                scale=f"{xscale} {zscale} {yscale}",
+                data={
+                    "Block": block_name,
+                    "Layer": rec.layer,
+                    "attribs": rec.attribs,
+                },
+            )
+        return records
+
+    def bounds(self, data):
+        # bounds in A-Frame axes of (vertices, faces) pairs
+        vertices = np.concatenate([np.reshape(v, (-1, 3)) for v, f in data])
+        return cad_box_to_gltf(vertices.min(axis=0), vertices.max(axis=0))
+
+    def add_entity(self, title, file, content_hash, lods=(), bounds=None):
+        # GLB vertices are already rotated to A-Frame axes
+        entity = Entity(
+            title=title,
+            description="Generated by django-a-frame",
+            switch=self.format == "obj",
+            content_hash=content_hash,
+            bounds=None if bounds is None else [corner.tolist() for corner in bounds],
+        )
+        self.entities.append((entity, file))
+        for level, distance, triangles, lod_file in lods:
+            lod = LevelOfDetail(
+                entity=entity, level=level, distance=distance, triangles=triangles
+            )
+            self.lods.append((lod, lod_file))
+        return entity
+
+    def add_staging(self, entity, **kwargs):
+        self.stagings.append(Staging(scene=self.scene, entity=entity, **kwargs))
+
+    def write(self, replace):
+        # files are saved to storage as soon as entities have an id,
+        # if anything fails they are deleted and the transaction rolled back
+        saved = []
+        try:
+            with transaction.atomic():
+                stagings = self.stagings
+                if replace:
+                    stale = self.delete_stale_stagings()
+                    stagings = self.new_stagings
+                for i in range(0, len(self.entities), self.batch_size):
+                    batch = self.entities[i : i + self.batch_size]
+                    entities = [entity for entity, file in batch]
+                    self.create_entities(entities)
+                    for entity, file in batch:
+                        field_file = self.field_file(entity)
+                        field_file.save(FORMATS[self.format][1], File(file), save=False)
+                        saved.append(field_file)
+                    Entity.objects.bulk_update(entities, ["obj_model", "gltf_model"])
+                extension = FORMATS[self.format][1].split(".")[-1]
+                for lod, file in self.lods:
+                    lod.model.save(
+                        f"lod{lod.level}.{extension}", File(file), save=False
+                    )
+                    saved.append(lod.model)
+                LevelOfDetail.objects.bulk_create(
+                    [lod for lod, file in self.lods], batch_size=self.batch_size
+                )
+                self.write_instance_groups(replace, saved)
+                Staging.objects.bulk_create(stagings, batch_size=self.batch_size)
+                if replace:
+                    delete_orphan_entities({st.entity_id for st in stale})
+                # bulk writes don't send the signals updating the version
+                touch_scenes([self.scene.id])
+        except Exception:
+            for field_file in saved:
+                field_file.storage.delete(field_file.name)
+            raise
+
+    def write_instance_groups(self, replace, saved):
+        # groups of a previous import are replaced
+        previous = InstanceGroup.objects.filter(scene=self.scene)
+        if not replace:
+            previous = previous.filter(
+                entity__in=[group.entity for group, file in self.instance_groups]
+            )
+        delete_instance_groups(previous)
+        for group, file in self.instance_groups:
+            group.model.save(f"instances_{group.entity.id}.glb", File(file), save=False)
+            saved.append(group.model)
+        InstanceGroup.objects.bulk_create(
+            [group for group, file in self.instance_groups],
+            batch_size=self.batch_size,
+        )
+
+    def delete_stale_stagings(self):
+        """
+        Matches stagings of a previous import with the new ones by
+        entity (i.e. content hash), layer or block name, transforms and
+        attributes. Unchanged stagings are kept, stale ones are deleted
+        and returned, the others are left in self.new_stagings.
+        Stagings added by hand are not touched.
+        """
+        previous = defaultdict(list)
+        for staging in self.scene.staged_entities.all():
+            if staging.data and "Layer" in staging.data:
+                previous[staging_key(staging)].append(staging)
+        self.new_stagings = []
+        for staging in self.stagings:
+            matches = previous.get(staging_key(staging))
+            if matches:
+                matches.pop()
+            else:
+                self.new_stagings.append(staging)
+        stale = [staging for group in previous.values() for staging in group]
+        # write() touches the scene and replaces its instance groups
+        # once for all
+        with receivers_muted():
+            for i in range(0, len(stale), self.batch_size):
+                batch = stale[i : i + self.batch_size]
+                Staging.objects.filter(
+                    id__in=[staging.id for staging in batch]
+                ).delete()
+        return stale
+
+    def field_file(self, entity):
+        if self.format == "glb":
+            return entity.gltf_model
+        return entity.obj_model
+
+    def create_entities(self, entities):
+        # stagings and file paths need primary keys of new entities
+        if connection.features.can_return_rows_from_bulk_insert:
+            Entity.objects.bulk_create(entities)
+        else:
+            for entity in entities:
+                entity.save()
+
+
+class StreamingDXFImporter(DXFImporter):
+    """
+    Imports big DXF files without loading the whole document: tables,
+    blocks and model space are read entity by entity with the iterdxf
+    add-on, and the geometry of each layer and block is accumulated by
+    a MeshWriter. Geometry and generated files of all layers and blocks
+    go to one shared temporary file on disk. Only layer colors, block
+    base points, compact insertion records and file segments are kept
+    in memory.
+    """
+
+    # entities read between two progress reports while scanning
+    REPORT_EVERY = 1000
+
+    def run(self, replace=False):
+        self.spool = SharedSpool()
+        try:
+            super().run(replace)
+        finally:
+            self.spool.close()
+
+    def read(self, path):
+        doc = opendxf(path)
+        writers = {}
+        try:
+            self.scan(doc, writers)
+            items = [(kind, name, writer) for (kind, name), writer in writers.items()]
+            digests = [writer.hexdigest() for kind, name, writer in items]
+            self.collect(items, digests, self.inserts)
+        finally:
+            doc.close()
+            for writer in writers.values():
+                writer.close()
+
+    def scan(self, doc, writers):
+        self.size = max(doc.file.seek(0, 2), 1)
+        self.layer_dict = layer_colors(
+            doc.load_entities(doc.sections["TABLES"] + 1, {"LAYER"})
+        )
+        # layers first, then blocks, as with the whole document
+        for name in self.layer_dict:
+            writers[("Layer", name)] = None
+        base_points = {}
+        block = None
+        for e in doc.load_entities(
+            doc.sections["BLOCKS"] + 1, {"BLOCK", "ENDBLK", "MESH"}
+        ):
+            dxftype = e.dxftype()
+            if dxftype == "BLOCK":
+                block = e.dxf.name
+                base_points[block] = e.dxf.base_point
+            elif dxftype == "ENDBLK":
+                block = None
+            elif block is not None and block != "*Model_Space":
+                self.add_mesh(writers, "Block", block, e)
+        self.inserts = defaultdict(list)
+        for i, e in enumerate(doc.modelspace(types=["MESH", "INSERT"])):
+            if e.dxftype() == "MESH":
+                if e.dxf.layer in self.layer_dict:
+                    self.add_mesh(writers, "Layer", e.dxf.layer, e)
+            else:
+                name = e.dxf.name
+                self.inserts[name].append(insert_record(e, base_points.get(name)))
+            if self.progress and i % self.REPORT_EVERY == 0:
+                self.progress(doc.file.tell(), 2 * self.size)
+        # drop layers without meshes
+        for key in [key for key, writer in writers.items() if writer is None]:
+            del writers[key]
+
+    def add_mesh(self, writers, kind, name, mesh):
+        writer = writers.get((kind, name))
+        if writer is None:
+            writer = writers[(kind, name)] = MeshWriter(self.salt, self.spool)
+        writer.add(mesh.vertices.values, list(mesh.faces))
+
+    def bounds(self, writer):
+        return cad_box_to_gltf(writer.min, writer.max)
+
+    def report(self, done, total):
+        # scanning is the first half of the job
+        if self.progress:
+            self.progress(total + done, 2 * total)
+
+    def convert(self, writers):
+        # files are written one after another from the spooled geometry
+        for writer in writers:
+            if not writer.face_count:
+                yield None, []
+                continue
+            file = self.spool.open()
+            if self.format == "glb":
+                writer.write_glb(file, self.precision)
+            else:
+                writer.write_obj(file)
+            file.seek(0)
+            yield file, []
+
+    def dump_instances(self, writer, matrices, colors):
+        if not writer.face_count:
+            return None
+        file = self.spool.open()
+        writer.write_instanced_glb(file, matrices, colors)
+        file.seek(0)
+        return file
+
+
+def get_importer(scene, progress=None):
+    """
+    Returns a StreamingDXFImporter if the scene DXF is at least
+    DJAFRAME_STREAMING_IMPORT_SIZE bytes, else a DXFImporter.
+    """
+    threshold = getattr(settings, "DJAFRAME_STREAMING_IMPORT_SIZE", None)
+    if threshold is not None and scene.dxf and scene.dxf.size >= threshold:
+        return StreamingDXFImporter(scene, progress=progress)
+    return DXFImporter(scene, progress=progress)
+
+
+def staging_key(staging):
+    # entity_id is None for entities not created yet
+    return (
+        staging.entity_id,
+        staging.position,
+        staging.rotation,
+        staging.scale,
+        staging.color,
+        json.dumps(staging.data, sort_keys=True),
+    )
+
+
+def delete_orphan_entities(entity_ids):
+    """
+    Deletes generated entities among entity_ids that are not staged
+    in any scene, their files are deleted once the transaction commits.
+    """
+    orphans = Entity.objects.filter(
+        id__in=entity_ids, content_hash__isnull=False, scenes=None
+    )
+    lods = LevelOfDetail.objects.filter(entity__in=orphans)
+    field_files = [lod.model for lod in lods]
+    for entity in orphans:
+        field_files += [entity.obj_model, entity.gltf_model]
+    for field_file in field_files:
+        if field_file:
+            transaction.on_commit(partial(field_file.storage.delete, field_file.name))
+    orphans.delete()
+
+
+def layer_colors(layers):
+    # layer name to hex color
+    layer_dict = {}
+    for layer in layers:
+        if layer.rgb:
+            color = cad2hex(layer.rgb)
+        else:
+            color = cad2hex(layer.color)
+        layer_dict[layer.dxf.name] = color
+    return layer_dict
+
+
+def insert_record(ins, base_point=None):
+    """
+    Returns what stagings need of an INSERT entity. Out of a document
+    ezdxf can't find the block, so base_point must be provided to
+    be subtracted from the insertion point.
+    """
+    m = ins.matrix44()
+    if base_point is not None:
+        m.origin = m.origin - m.transform_direction(base_point)
+    attribs = {attr.dxf.tag: attr.dxf.text for attr in ins.attribs}
+    return InsertRecord(
+        ins.dxf.layer,
+        tuple(m),
+        (ins.dxf.xscale, ins.dxf.yscale, ins.dxf.zscale),
+        attribs,
+    )
+
+
+def index_modelspace(msp):
+    """
+    Scans model space once, returns MESH entities grouped by layer
+    and INSERT entities grouped by block name.
+    """
+    meshes = defaultdict(list)
+    inserts = defaultdict(list)
+    for e in msp:
+        dxftype = e.dxftype()
+        if dxftype == "MESH":
+            meshes[e.dxf.layer].append(e)
+        elif dxftype == "INSERT":
+            inserts[e.dxf.name].append(e)
+    return meshes, inserts
+
+
+def mesh_data(meshes):
+    # picklable vertices and faces of MESH entities
+    return [(m.vertices.values, list(m.faces)) for m in meshes]
+
+
+def spool_converted(converted):
+    # spools file contents returned by convert_meshes
+    content, lods = converted
+    if content is None:
+        return None, []
+    return spool(content), [
+        (level, distance, triangles, spool(lod_content))
+        for level, distance, triangles, lod_content in lods
+    ]
+
+
+def spool(content):
+    """
+    Returns content as a file kept in memory, that spills to an
+    anonymous temporary file if it is bigger than SPOOL_MAX_SIZE.
+    """
+    f = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+b")
+    f.write(content)
+    f.seek(0)
+    return f
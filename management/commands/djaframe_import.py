@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...tasks import run_pending_jobs, run_pending_skies, run_pending_textures
+from ...uploads import delete_expired_uploads
+
+
+class Command(BaseCommand):
+    help = "Process pending DXF import jobs, material and scene images"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process pending jobs and exit instead of polling",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5.0,
+            help="Seconds between polls of the job queue",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_jobs()
+            if count:
+                self.stdout.write(f"Processed {count} import job(s)")
+            count = run_pending_textures()
+            if count:
+                self.stdout.write(f"Optimized {count} material image(s)")
+            count = run_pending_skies()
+            if count:
+                self.stdout.write(f"Generated {count} sky pyramid(s)")
+            count = delete_expired_uploads()
+            if count:
+                self.stdout.write(f"Deleted {count} expired upload(s)")
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0014_importjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="Hash of geometry generated from DXF",
+                max_length=64,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0015_entity_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="modified",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="version",
+            field=models.PositiveIntegerField(
+                default=0,
+                editable=False,
+                help_text="Incremented whenever the scene or what it stages changes",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:37
+
+import djaframe.models
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0016_scene_version_modified"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LevelOfDetail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("level", models.PositiveSmallIntegerField(default=1)),
+                ("distance", models.FloatField(help_text="Shown beyond this distance")),
+                (
+                    "model",
+                    models.FileField(
+                        max_length=200,
+                        upload_to=djaframe.models.lod_directory_path,
+                        validators=[
+                            django.core.validators.FileExtensionValidator(
+                                allowed_extensions=["obj", "glb"]
+                            )
+                        ],
+                    ),
+                ),
+                ("triangles", models.PositiveIntegerField(default=0)),
+                (
+                    "entity",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="lods",
+                        to="djaframe.entity",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Level of detail",
+                "verbose_name_plural": "Levels of detail",
+                "ordering": ("entity", "level"),
+            },
+        ),
+    ]
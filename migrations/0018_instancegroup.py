@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+import djaframe.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0017_levelofdetail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InstanceGroup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "model",
+                    models.FileField(
+                        max_length=200,
+                        upload_to=djaframe.models.instance_group_directory_path,
+                    ),
+                ),
+                ("count", models.PositiveIntegerField(help_text="Number of stagings")),
+                (
+                    "entity",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="instance_groups",
+                        to="djaframe.entity",
+                    ),
+                ),
+                (
+                    "scene",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="instance_groups",
+                        to="djaframe.scene",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Instance group",
+                "verbose_name_plural": "Instance groups",
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:48
+
+import djaframe.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0018_instancegroup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BakedScene",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "model",
+                    models.FileField(
+                        max_length=200,
+                        upload_to=djaframe.models.baked_scene_directory_path,
+                    ),
+                ),
+                (
+                    "version",
+                    models.PositiveIntegerField(help_text="Scene version it shows"),
+                ),
+                (
+                    "entities",
+                    models.JSONField(
+                        blank=True,
+                        default=list,
+                        help_text="Entities whose stagings are in the model",
+                    ),
+                ),
+                (
+                    "scene",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="baked",
+                        to="djaframe.scene",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Baked scene",
+                "verbose_name_plural": "Baked scenes",
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0019_bakedscene"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="materialimage",
+            name="variants",
+            field=models.JSONField(
+                blank=True,
+                editable=False,
+                help_text="Optimized copies, empty until the worker writes them",
+                null=True,
+            ),
+        ),
+    ]
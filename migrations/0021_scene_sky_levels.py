@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0020_materialimage_variants"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="sky_levels",
+            field=models.JSONField(
+                blank=True,
+                editable=False,
+                help_text="Resolution pyramid of the image, empty until the worker writes it",
+                null=True,
+            ),
+        ),
+    ]
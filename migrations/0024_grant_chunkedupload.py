@@ -0,0 +1,34 @@
+from django.contrib.auth.management import create_permissions
+from django.db import migrations
+from django.utils.translation import gettext as _
+
+
+def grant_chunkedupload(apps, schema_editor):
+    # groups created before chunked uploads miss their permissions
+    Group = apps.get_model("auth", "Group")
+    Permission = apps.get_model("auth", "Permission")
+    group = Group.objects.filter(name=_("3D Manager")).first()
+    if group is None:
+        return
+    app_config = apps.get_app_config("djaframe")
+    app_config.models_module = True
+    create_permissions(app_config, apps=apps, verbosity=0)
+    group.permissions.add(
+        *Permission.objects.filter(
+            content_type__app_label="djaframe",
+            content_type__model="chunkedupload",
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("djaframe", "0023_importjob_superseded"),
+    ]
+
+    operations = [
+        migrations.RunPython(grant_chunkedupload, migrations.RunPython.noop),
+    ]
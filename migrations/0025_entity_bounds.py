@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0024_grant_chunkedupload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="bounds",
+            field=models.JSONField(
+                blank=True,
+                editable=False,
+                help_text="Low and high corners of geometry generated from DXF",
+                null=True,
+            ),
+        ),
+    ]
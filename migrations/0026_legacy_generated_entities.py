@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models.functions import Cast, Concat
+
+
+def mark_legacy_entities(apps, schema_editor):
+    # entities generated before content hashes get one that matches no
+    # geometry, so that re-imports delete them once they are orphans
+    Entity = apps.get_model("djaframe", "Entity")
+    Entity.objects.filter(
+        models.Q(title__startswith="Layer ") | models.Q(title__startswith="Block "),
+        content_hash__isnull=True,
+        description="Generated by django-a-frame",
+    ).update(
+        content_hash=Concat(
+            models.Value("legacy-"), Cast("id", output_field=models.CharField())
+        )
+    )
+
+
+def unmark_legacy_entities(apps, schema_editor):
+    Entity = apps.get_model("djaframe", "Entity")
+    Entity.objects.filter(content_hash__startswith="legacy-").update(content_hash=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djaframe", "0025_entity_bounds"),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_legacy_entities, unmark_legacy_entities),
+    ]
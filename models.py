@@ -1,16 +1,19 @@
-from math import asin, atan2, copysign, cos, degrees, fabs, pi
+import os
+import re
+import shutil
+import uuid
+from math import asin, atan2, copysign, cos, fabs, pi
 from pathlib import Path
+from tempfile import NamedTemporaryFile
 
-import ezdxf
 import numpy as np
 from django.conf import settings
-from django.core.files import File
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from ezdxf import colors
-from ezdxf.addons import meshex
-from ezdxf.math import Vec3
-from ezdxf.render import MeshBuilder
+
+from .geometry import aframe_matrix
 
 
 def entity_directory_path(instance, filename):
@@ -66,6 +69,23 @@ class Entity(models.Model):
         blank=True,
     )
     switch = models.BooleanField(default=False, help_text="Switch Z/Y axis")
+    content_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=True,
+        help_text="Hash of geometry generated from DXF",
+    )
+    bounds = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Low and high corners of geometry generated from DXF",
+    )
+
+    # fields making up the model A-Frame shows
+    MODEL_FIELDS = {"gltf_model", "obj_model", "mtl_model", "switch"}
 
     class Meta:
         verbose_name = "Entity"
@@ -74,70 +94,84 @@ class Entity(models.Model):
     def __str__(self):
         return self.title
 
+    def forget_generated_geometry(self):
+        # changed files no longer match geometry generated from DXF
+        self.content_hash = None
+        self.bounds = None
+        for lod in self.lods.all():
+            lod.model.delete(save=False)
+            lod.delete()
+
     def check_material_file_name(self):
         # this function should be called only if
         # obj_model and mtl_model exist
 
         # get the material file name
         mtl_name = self.mtl_model.name.split("/")[-1]
-        # get file paths for object file and helper file
-        helper_path = Path(settings.MEDIA_ROOT).joinpath(
-            "uploads/djaframe/scene/temp.obj"
+        mtllib = f"mtllib {mtl_name}".encode()
+        return rewrite_file(
+            self.obj_model.path,
+            lambda line: (
+                mtllib + line[len(line.rstrip(b"\r\n")) :]
+                if line.startswith(b"mtllib")
+                else line
+            ),
         )
-        obj_path = Path(self.obj_model.path)
-        # copy helper from object file
-        with open(obj_path, "r") as o_f, open(helper_path, "w") as h_f:
-            for line in o_f:
-                if line.startswith("mtllib"):
-                    h_f.write(f"mtllib {mtl_name}\n")
-                else:
-                    h_f.write(line)
-        # copy object file back
-        with open(obj_path, "w") as o_f, open(helper_path, "r") as h_f:
-            for line in h_f:
-                o_f.write(line)
 
     def check_image_file_name(self):
         # this function should be called only if
         # images and mtl_model exist
 
-        # get image names as a dictionary
-        image_dict = {}
-        for img in self.material_images.all():
-            img_name = img.image.name.split("/")[-1]
-            image_dict[img_name.split(".")[0]] = img_name.split(".")[1]
-        # get file paths for material file and helper file
-        helper_path = Path(settings.MEDIA_ROOT).joinpath(
-            "uploads/djaframe/scene/temp.obj"
-        )
-        mtl_path = Path(self.mtl_model.path)
-        # copy helper from material file
-        with open(mtl_path, "r") as m_f, open(helper_path, "w") as h_f:
-            for line in m_f:
-                if "map_Ka " in line:
-                    start = line.split("map_Ka ")[0]
-                    rest = line.split("map_Ka ")[-1]
-                    name = rest.split(".")[0]
-                    for key, value in image_dict.items():
-                        if name == key:
-                            h_f.write(line)
-                        elif name in key:
-                            h_f.write(f"{start}map_Ka {key}.{value}\n")
-                elif "map_Kd " in line:
-                    start = line.split("map_Kd ")[0]
-                    rest = line.split("map_Kd ")[-1]
-                    name = rest.split(".")[0]
-                    for key, value in image_dict.items():
-                        if name == key:
-                            h_f.write(line)
-                        elif name in key:
-                            h_f.write(f"{start}map_Kd {key}.{value}\n")
-                else:
-                    h_f.write(line)
-        # copy material file back
-        with open(mtl_path, "w") as m_f, open(helper_path, "r") as h_f:
-            for line in h_f:
-                m_f.write(line)
+        # get names of images for the client profile by texture name
+        index = texture_index(self.material_images.all())
+
+        def replace_line(line):
+            # texture file is the last argument of map directives
+            words = line.split()
+            if len(words) < 2 or words[0].lower() not in TEXTURE_DIRECTIVES:
+                return line
+            image = index.get(texture_stem(words[-1]))
+            if image is None:
+                return line
+            start = line.rindex(words[-1])
+            return line[:start] + image + line[start + len(words[-1]) :]
+
+        return rewrite_file(self.mtl_model.path, replace_line)
+
+
+def lod_directory_path(instance, filename):
+    return "uploads/djaframe/obj/{0}/{1}".format(instance.entity.id, filename)
+
+
+class LevelOfDetail(models.Model):
+    entity = models.ForeignKey(
+        Entity,
+        on_delete=models.CASCADE,
+        related_name="lods",
+    )
+    level = models.PositiveSmallIntegerField(default=1)
+    distance = models.FloatField(help_text="Shown beyond this distance")
+    model = models.FileField(
+        max_length=200,
+        upload_to=lod_directory_path,
+        validators=[
+            FileExtensionValidator(
+                allowed_extensions=[
+                    "obj",
+                    "glb",
+                ]
+            )
+        ],
+    )
+    triangles = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Level of detail"
+        verbose_name_plural = "Levels of detail"
+        ordering = ("entity", "level")
+
+    def __str__(self):
+        return f"{self.entity} LOD {self.level}"
 
 
 def material_image_directory_path(instance, filename):
@@ -152,10 +186,59 @@ class MaterialImage(models.Model):
         verbose_name="Material image",
     )
     image = models.ImageField(upload_to=material_image_directory_path)
+    variants = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Optimized copies, empty until the worker writes them",
+    )
 
     def __str__(self):
         return Path(self.image.url).name
 
+    __original_image = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_image = self.image
+
+    def save(self, *args, **kwargs):
+        # save and eventually queue optimization of a new image
+        if self.__original_image != self.image:
+            from .textures import delete_variants
+
+            delete_variants(self.variants, self.image.storage)
+            self.variants = None
+        super().save(*args, **kwargs)
+        if self.variants is None:
+            from .tasks import enqueue_texture
+
+            image_id = self.id
+            transaction.on_commit(lambda: enqueue_texture(image_id))
+        self.__original_image = self.image
+
+    def texture_name(self):
+        """
+        File name of the variant closest to the client profile, not
+        bigger than DJAFRAME_TEXTURE_SIZE and WebP if DJAFRAME_TEXTURE_WEBP,
+        or of the image itself if it has no variants.
+        """
+        webp = getattr(settings, "DJAFRAME_TEXTURE_WEBP", True)
+        size = getattr(settings, "DJAFRAME_TEXTURE_SIZE", 2048)
+        variants = [
+            variant
+            for variant in self.variants or []
+            if (variant["format"] == "webp") == webp
+        ]
+        if not variants:
+            return Path(self.image.name).name
+        fitting = [v for v in variants if max(v["width"], v["height"]) <= size]
+        if fitting:
+            variant = max(fitting, key=lambda v: v["width"] * v["height"])
+        else:
+            variant = min(variants, key=lambda v: v["width"] * v["height"])
+        return Path(variant["name"]).name
+
 
 class Scene(models.Model):
 
@@ -183,6 +266,19 @@ class Scene(models.Model):
         ],
     )
 
+    sky_levels = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Resolution pyramid of the image, empty until the worker writes it",
+    )
+    version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Incremented whenever the scene or what it stages changes",
+    )
+    modified = models.DateTimeField(auto_now=True)
+
     class Meta:
         verbose_name = "Scene"
         verbose_name_plural = "Scenes"
@@ -191,146 +287,212 @@ class Scene(models.Model):
         return self.title
 
     __original_dxf = None
+    __original_image = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__original_dxf = self.dxf
+        # not loaded by refresh_from_db(fields=...)
+        deferred = self.get_deferred_fields()
+        if "dxf" not in deferred:
+            self.__original_dxf = self.dxf
+        if "image" not in deferred:
+            self.__original_image = self.image
 
     def save(self, *args, **kwargs):
-        # save and eventually upload DXF
+        # save and eventually queue DXF import and sky pyramid
+        if not self._state.adding:
+            self.version = models.F("version") + 1
+        if self.__original_image is not None and self.__original_image != self.image:
+            from .skies import delete_levels
+
+            delete_levels(self.sky_levels, self.image.storage)
+            self.sky_levels = None
         super().save(*args, **kwargs)
-        if self.__original_dxf != self.dxf:
-            all_objects = self.staged_entities.all()
-            if all_objects.exists():
-                all_objects.delete()
-            self.create_objs_from_dxf()
-
-    def create_objs_from_dxf(self):
-        doc = ezdxf.readfile(self.dxf.path)
-        # make layer dict
-        layer_dict = {}
-        for layer in doc.layers:
-            if layer.rgb:
-                color = cad2hex(layer.rgb)
-            else:
-                color = cad2hex(layer.color)
-            layer_dict[layer.dxf.name] = color
-        # get model space
-        msp = doc.modelspace()
-        # prepare two helper files
-        path = Path(settings.MEDIA_ROOT).joinpath("uploads/djaframe/scene/temp.obj")
-        path2 = Path(settings.MEDIA_ROOT).joinpath("uploads/djaframe/scene/temp2.obj")
-        # iterate over layers
-        for name, color in layer_dict.items():
-            # write first file recording vertex number
-            with open(path, "w") as f:
-                for m in msp.query(f"MESH[layer=='{name}']"):
-                    mb = MeshBuilder()
-                    mb.vertices = Vec3.list(m.vertices)
-                    mb.faces = m.faces
-                    f.write(meshex.obj_dumps(mb))
-                    f.write(f"# total vertices={len(m.vertices)}\n")
-            # pass values from one file to the other
-            with open(path, "r") as f, open(path2, "w") as f2:
-                # file is empty, pass
-                if len(f.readlines()) == 0:
-                    continue
-                # rewind file!
-                f.seek(0)
-                f2.write("# Generated by django-a-frame\n")
-                # offset face number by total vertex number
-                n = 0
-                for line in f:
-                    if line.startswith("v"):
-                        f2.write(line)
-                    elif line.startswith("# total vertices="):
-                        n += int(line.split("=")[1])
-                    elif line.startswith("f"):
-                        fc = line.split(" ")
-                        f2.write(f"f {int(fc[1])+n} {int(fc[2])+n} {int(fc[3])+n}\n")
-            with open(path2, "r") as f:
-                entity = Entity.objects.create(
-                    title=f"Layer {name}",
-                    description="Generated by django-a-frame",
-                    switch=True,
-                )
-                entity.obj_model = File(f, name="object.obj")
-                entity.save()
-                Staging.objects.create(
-                    scene=self,
-                    entity=entity,
-                    color=color,
-                    data={"Layer": name},
-                )
-        # iterate over blocks
-        for block in doc.blocks:
-            if block.name in [
-                "*Model_Space",
-            ]:
-                continue
-            # write first file recording vertex number
-            with open(path, "w") as f:
-                for m in block.query("MESH"):
-                    mb = MeshBuilder()
-                    mb.vertices = Vec3.list(m.vertices)
-                    mb.faces = m.faces
-                    f.write(meshex.obj_dumps(mb))
-                    f.write(f"# total vertices={len(m.vertices)}\n")
-            # pass values from one file to the other
-            with open(path, "r") as f, open(path2, "w") as f2:
-                # file is empty, pass
-                if len(f.readlines()) == 0:
-                    continue
-                # rewind file!
-                f.seek(0)
-                f2.write("# Generated by django-a-frame\n")
-                # offset face number by total vertex number
-                n = 0
-                for line in f:
-                    if line.startswith("v"):
-                        f2.write(line)
-                    elif line.startswith("# total vertices="):
-                        n += int(line.split("=")[1])
-                    elif line.startswith("f"):
-                        fc = line.split(" ")
-                        f2.write(f"f {int(fc[1])+n} {int(fc[2])+n} {int(fc[3])+n}\n")
-            with open(path2, "r") as f:
-                # we create the block entity
-                entity = Entity.objects.create(
-                    title=f"Block {block.name}",
-                    description="Generated by django-a-frame",
-                    switch=True,
-                )
-                entity.obj_model = File(f, name="object.obj")
-                entity.save()
-            # we look for insertions of the block
-            for ins in msp.query(f"INSERT[name=='{block.name}']"):
-                # extract attributes
-                attrib_dict = {}
-                if ins.attribs:
-                    for attr in ins.attribs:
-                        attrib_dict[attr.dxf.tag] = attr.dxf.text
-                # for 3D rotated insertions we need origin of local coords
-                origin = ins.ucs().origin
-                # and vectors of local coords...
-                R = np.asarray(
-                    [list(ins.ucs().ux), list(ins.ucs().uy), list(ins.ucs().uz)]
-                )
-                # ...to extract 3D rotation of insertion
-                yaw, roll, pitch, gimbal_lock = rotation_matrix_to_euler_angles_zyx(R)
-                Staging.objects.create(
-                    scene=self,
-                    entity=entity,
-                    color=layer_dict[ins.dxf.layer],
-                    position=(f"{origin[0]} {origin[2]} {-origin[1]}"),
-                    rotation=f"{degrees(-pitch)} {degrees(-yaw)} {degrees(roll)}",
-                    scale=f"{ins.dxf.xscale} {ins.dxf.zscale} {ins.dxf.yscale}",
-                    data={
-                        "Block": block.name,
-                        "Layer": ins.dxf.layer,
-                        "attribs": attrib_dict,
-                    },
-                )
+        if isinstance(self.version, models.Expression):
+            self.refresh_from_db(fields=["version"])
+        if self.__original_dxf is not None and self.__original_dxf != self.dxf:
+            from .tasks import enqueue_import
+
+            # only the last upload is worth importing
+            self.import_jobs.filter(status=ImportJob.Status.PENDING).update(
+                status=ImportJob.Status.SUPERSEDED, finished=timezone.now()
+            )
+            job = ImportJob.objects.create(scene=self)
+            transaction.on_commit(lambda: enqueue_import(job.id))
+            self.__original_dxf = self.dxf
+        if self.image and self.sky_levels is None:
+            from .tasks import enqueue_sky
+
+            scene_id = self.id
+            transaction.on_commit(lambda: enqueue_sky(scene_id))
+        self.__original_image = self.image
+
+    def sky_urls(self):
+        # urls of the pyramid levels, smallest first, and of the image
+        if not self.image:
+            return []
+        storage = self.image.storage
+        levels = [storage.url(level["name"]) for level in self.sky_levels or []]
+        return levels + [self.image.url]
+
+    def import_dxf(self, progress=None):
+        # called by the import worker, with no DXF file
+        # stagings of the previous import are removed
+        self.create_objs_from_dxf(progress=progress, replace=True)
+
+    def create_objs_from_dxf(self, progress=None, replace=False):
+        from .importer import get_importer
+
+        get_importer(self, progress=progress).run(replace=replace)
+
+    def bake(self, skipped=None):
+        from .baking import bake_scene
+
+        return bake_scene(self, skipped)
+
+
+class ImportJob(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+        SUPERSEDED = "superseded", "Superseded"
+
+    scene = models.ForeignKey(
+        Scene,
+        on_delete=models.CASCADE,
+        related_name="import_jobs",
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=Status,
+        default=Status.PENDING,
+    )
+    progress = models.PositiveSmallIntegerField(default=0, help_text="Percent")
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Import job"
+        verbose_name_plural = "Import jobs"
+        ordering = ("-created",)
+
+    def __str__(self):
+        return f"Import job {self.id}"
+
+    @property
+    def is_active(self):
+        return self.status in [self.Status.PENDING, self.Status.RUNNING]
+
+    def set_progress(self, done, total):
+        progress = int(100 * done / total) if total else 100
+        if progress != self.progress:
+            self.progress = progress
+            ImportJob.objects.filter(id=self.id).update(progress=progress)
+
+
+def instance_group_directory_path(instance, filename):
+    return "uploads/djaframe/scene/{0}/{1}".format(instance.scene.id, filename)
+
+
+class InstanceGroup(models.Model):
+    # all the stagings of an entity in a scene, drawn with GPU instancing
+    scene = models.ForeignKey(
+        Scene,
+        on_delete=models.CASCADE,
+        related_name="instance_groups",
+    )
+    entity = models.ForeignKey(
+        Entity,
+        on_delete=models.CASCADE,
+        related_name="instance_groups",
+    )
+    model = models.FileField(
+        max_length=200,
+        upload_to=instance_group_directory_path,
+    )
+    count = models.PositiveIntegerField(help_text="Number of stagings")
+
+    class Meta:
+        verbose_name = "Instance group"
+        verbose_name_plural = "Instance groups"
+
+    def __str__(self):
+        return f"{self.entity} x {self.count}"
+
+
+def baked_scene_directory_path(instance, filename):
+    return "uploads/djaframe/scene/{0}/{1}".format(instance.scene.id, filename)
+
+
+class BakedScene(models.Model):
+    # all the stagings of a scene merged in a single model
+    scene = models.OneToOneField(
+        Scene,
+        on_delete=models.CASCADE,
+        related_name="baked",
+    )
+    model = models.FileField(
+        max_length=200,
+        upload_to=baked_scene_directory_path,
+    )
+    version = models.PositiveIntegerField(help_text="Scene version it shows")
+    entities = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Entities whose stagings are in the model",
+    )
+
+    class Meta:
+        verbose_name = "Baked scene"
+        verbose_name_plural = "Baked scenes"
+
+    def __str__(self):
+        return f"{self.scene} baked"
+
+
+class ChunkedUpload(models.Model):
+    # big file received in chunks, until it is attached to a file field
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="djaframe_uploads",
+    )
+    filename = models.CharField(max_length=200)
+    size = models.PositiveBigIntegerField(help_text="Bytes")
+    offset = models.PositiveBigIntegerField(default=0, help_text="Bytes received")
+    expected_sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text="Hex digest given by the client, checked once complete",
+    )
+    sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+        help_text="Hex digest of the received file, once complete",
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Chunked upload"
+        verbose_name_plural = "Chunked uploads"
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def file_name(self):
+        # storage name of the file being assembled
+        return f"uploads/djaframe/chunked/{self.id}/{self.filename}"
 
 
 class Staging(models.Model):
@@ -372,6 +534,14 @@ class Staging(models.Model):
     def __str__(self):
         return f"Staging {self.id}"
 
+    def matrix(self):
+        # (4, 4) transform as A-Frame applies it
+        return aframe_matrix(
+            parse_vector(self.position, 0),
+            parse_vector(self.rotation, 0),
+            parse_vector(self.scale, 1),
+        )
+
     def popupContent(self):
         if not self.data:
             return
@@ -392,6 +562,94 @@ class Staging(models.Model):
 """
 
 
+def rewrite_file(path, replace_line):
+    """
+    Streams lines of the file at path through replace_line into a
+    unique temporary file in the same directory, then swaps it in
+    place of the file with the same permissions, so that concurrent
+    rewrites and readers never see a partial file. The file is left
+    alone if no line changed, returns whether it was rewritten.
+    """
+    path = Path(path)
+    changed = False
+    with (
+        open(path, "rb") as f,
+        NamedTemporaryFile(
+            "wb", dir=path.parent, prefix=f".{path.name}.", delete=False
+        ) as temp,
+    ):
+        try:
+            for line in f:
+                new_line = replace_line(line)
+                changed = changed or new_line != line
+                temp.write(new_line)
+        except BaseException:
+            temp.close()
+            os.unlink(temp.name)
+            raise
+    if not changed:
+        os.unlink(temp.name)
+        return False
+    shutil.copymode(path, temp.name)
+    os.replace(temp.name, path)
+    return True
+
+
+# MTL directives with a texture file as last argument
+TEXTURE_DIRECTIVES = {
+    b"map_ka",
+    b"map_kd",
+    b"map_ks",
+    b"map_ke",
+    b"map_ns",
+    b"map_d",
+    b"map_bump",
+    b"bump",
+    b"disp",
+    b"decal",
+    b"refl",
+    b"norm",
+    b"map_pr",
+    b"map_pm",
+    b"map_ps",
+}
+
+# Suffix added by Django storages to names of existing files
+RENAMED_SUFFIX = re.compile(rb"(.+)_[a-zA-Z0-9]{7}")
+
+
+def texture_stem(name):
+    # file name without directories and extension, as bytes
+    return name.replace(b"\\", b"/").rsplit(b"/", 1)[-1].rsplit(b".", 1)[0]
+
+
+def texture_index(material_images):
+    """
+    Returns texture file names (as bytes) of material images by stem of
+    the image and of its variants. Images are also found by their stem
+    without the suffix Django adds when a file name is taken, so that
+    "wood.jpg" in an MTL file finds "wood_AbC1234.jpg". Exact stems
+    win over renamed ones.
+    """
+    index = {}
+    renamed = {}
+    for matimg in sorted(material_images, key=lambda matimg: matimg.image.name):
+        name = matimg.texture_name().encode()
+        stem = texture_stem(Path(matimg.image.name).name.encode())
+        index[stem] = name
+        for variant in matimg.variants or []:
+            index[texture_stem(Path(variant["name"]).name.encode())] = name
+        if match := RENAMED_SUFFIX.fullmatch(stem):
+            renamed.setdefault(match[1], name)
+    return renamed | index
+
+
+def parse_vector(value, default):
+    # A-Frame vector property, missing values take default
+    values = [float(v) for v in value.split()[:3]]
+    return values + [default] * (3 - len(values))
+
+
 def cad2hex(color):
     if isinstance(color, tuple):
         return "#{:02x}{:02x}{:02x}".format(color[0], color[1], color[2])
@@ -432,3 +690,31 @@ def rotation_matrix_to_euler_angles_zyx(R):
         z = atan2(R[1, 0] / cy, R[0, 0] / cy)
         gimbal_lock = False
     return z, y, x, gimbal_lock
+
+
+def rotation_matrices_to_euler_angles_zyx(R):
+    """
+    Batched version of rotation_matrix_to_euler_angles_zyx.
+
+    R is an (N, 3, 3) stack of rotation matrices, returns arrays of
+    z, y, x angles and gimbal lock flags, with the same conventions
+    of the single matrix function.
+
+    """
+    R = np.asarray(R, dtype=np.float64)
+    gimbal_lock = np.fabs(np.fabs(R[:, 2, 0]) - 1) < EPSILON
+    # clip keeps rounding errors out of arcsin domain
+    y = np.where(
+        gimbal_lock,
+        np.copysign(pi / 2, -R[:, 2, 0]),
+        -np.arcsin(np.clip(R[:, 2, 0], -1, 1)),
+    )
+    # cos(y) is zero only in gimbal lock, where it is not used
+    cy = np.where(gimbal_lock, 1, np.cos(y))
+    x = np.where(gimbal_lock, 0, np.arctan2(R[:, 2, 1] / cy, R[:, 2, 2] / cy))
+    z = np.where(
+        gimbal_lock,
+        np.arctan2(R[:, 0, 1], R[:, 0, 2]),
+        np.arctan2(R[:, 1, 0] / cy, R[:, 0, 0] / cy),
+    )
+    return z, y, x, gimbal_lock
@@ -0,0 +1,89 @@
+"""
+Resolution pyramid of scene skies
+
+Equirectangular images of scenes can be many thousands pixels wide and
+take long to download and decode. The background worker writes a tiny
+blurred preview and copies halving the width of the image down to
+DJAFRAME_SKY_MIN_WIDTH, next to the image: the A-Frame window shows the
+preview at once and the djaframe-sky component swaps in bigger levels
+as they load, up to the image itself. Level names only depend on the
+image name, so the pyramid can be written again over the same files.
+"""
+
+import logging
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image, ImageFilter, UnidentifiedImageError
+
+from .models import Scene
+from .textures import encode_texture
+
+logger = logging.getLogger(__name__)
+
+
+def sky_levels(f, min_width, preview_width):
+    """
+    Returns Pillow images of the pyramid of image file f, smallest
+    first: the blurred preview, then halving widths from the image down
+    to min_width, the image itself left out.
+    """
+    with Image.open(f) as image:
+        image = image.convert("RGB")
+    levels = []
+    while image.width // 2 >= min_width:
+        image = image.reduce(2)
+        levels.append(image)
+    height = max(round(image.height * preview_width / image.width), 1)
+    preview = image.resize((preview_width, height), Image.Resampling.BOX)
+    return [preview.filter(ImageFilter.GaussianBlur(1))] + levels[::-1]
+
+
+def generate_sky(scene_id):
+    """
+    Writes the pyramid of the image of a scene, unless it has one
+    already, and changes the scene version. Images Pillow can't read
+    get an empty pyramid.
+    """
+    scene = Scene.objects.filter(id=scene_id).first()
+    if scene is None or not scene.image or scene.sky_levels is not None:
+        return
+    image = scene.image
+    stem = Path(image.name).stem
+    levels = []
+    try:
+        with image.open("rb") as f:
+            pyramid = sky_levels(
+                f,
+                getattr(settings, "DJAFRAME_SKY_MIN_WIDTH", 1024),
+                getattr(settings, "DJAFRAME_SKY_PREVIEW_WIDTH", 64),
+            )
+        for i, level in enumerate(pyramid):
+            suffix = "preview" if i == 0 else level.width
+            name = str(Path(image.name).with_name(f"{stem}_sky_{suffix}.jpg"))
+            # written again over the same name
+            image.storage.delete(name)
+            name = image.storage.save(name, ContentFile(encode_texture(level, "jpeg")))
+            levels.append({"width": level.width, "height": level.height, "name": name})
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.exception("Sky pyramid of scene %s failed", scene_id)
+        delete_levels(levels, image.storage)
+        levels = []
+    # update() keeps save() from queueing it again
+    if not Scene.objects.filter(
+        id=scene_id, image=image.name, sky_levels__isnull=True
+    ).update(sky_levels=levels, version=F("version") + 1, modified=timezone.now()):
+        # image changed or pyramid written meanwhile by another worker
+        current = Scene.objects.filter(id=scene_id).values_list("sky_levels", flat=True)
+        kept = {level["name"] for level in current.first() or []}
+        delete_levels(
+            [level for level in levels if level["name"] not in kept], image.storage
+        )
+
+
+def delete_levels(levels, storage):
+    for level in levels or []:
+        storage.delete(level["name"])
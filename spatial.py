@@ -0,0 +1,154 @@
+"""
+Spatial index of stagings
+
+World bounding boxes of the stagings of a scene are computed from the
+bounds of their entities and their transforms, and cached per scene
+version as NumPy arrays, like the scene markup: box and radius queries
+are a vectorized scan of them, tiles group them on the ground plane
+for progressive loading. Bounds of entities generated from DXF are
+recorded by the import, others are read once and cached until the
+entity changes. Stagings of entities whose bounds can't be read match
+any query.
+"""
+
+import numpy as np
+from django.conf import settings
+
+from .caching import get_cache
+from .geometry import (
+    READ_ERRORS,
+    cad_box_to_gltf,
+    gltf_bounds,
+    read_gltf_json,
+    read_obj_bounds,
+    transform_boxes,
+)
+
+
+def entity_bounds_key(entity_id):
+    return f"djaframe:entity:{entity_id}:bounds"
+
+
+def entity_bounds(entity):
+    """
+    Returns (low, high) bounds of entity in A-Frame axes, or None if
+    its model can't be read.
+    """
+    cache = get_cache()
+    key = entity_bounds_key(entity.id)
+    bounds = cache.get(key)
+    if bounds is None:
+        # unreadable models are cached too, as an empty tuple
+        bounds = read_entity_bounds(entity) or ()
+        cache.set(key, bounds, None)
+    return bounds or None
+
+
+def read_entity_bounds(entity):
+    # bounds recorded by the DXF import, else read from the model
+    if entity.bounds:
+        return tuple(np.array(corner) for corner in entity.bounds)
+    try:
+        if entity.gltf_model:
+            with entity.gltf_model.open("rb") as f:
+                return gltf_bounds(read_gltf_json(f))
+        if not entity.obj_model:
+            return None
+        with entity.obj_model.open("rb") as f:
+            bounds = read_obj_bounds(f)
+    except READ_ERRORS:
+        return None
+    if bounds is None or not entity.switch:
+        return bounds
+    return cad_box_to_gltf(*bounds)
+
+
+def scene_index(scene):
+    """
+    Returns staging ids, (N, 3) low and high bounds and centers of
+    stagings of scene, from the cache if they are up to date. Centers
+    of stagings without bounds are their positions.
+    """
+    cache = get_cache()
+    key = f"djaframe:scene:{scene.id}:{scene.version}:index"
+    index = cache.get(key)
+    if index is None:
+        index = build_index(
+            scene.staged_entities.select_related("entity").order_by("id")
+        )
+        cache.set(key, index, getattr(settings, "DJAFRAME_SCENE_CACHE_TIMEOUT", 3600))
+    return index
+
+
+def build_index(stagings):
+    ids, lows, highs, matrices = [], [], [], []
+    unbounded, positions = [], []
+    for staging in stagings:
+        bounds = entity_bounds(staging.entity)
+        try:
+            matrix = staging.matrix()
+        except ValueError:
+            bounds, matrix = None, np.eye(4)
+        if bounds is None:
+            unbounded.append(staging.id)
+            positions.append(matrix[:3, 3])
+            continue
+        ids.append(staging.id)
+        lows.append(bounds[0])
+        highs.append(bounds[1])
+        matrices.append(matrix)
+    low = np.full((len(unbounded), 3), -np.inf)
+    high = np.full((len(unbounded), 3), np.inf)
+    centers = np.array(positions).reshape(-1, 3)
+    if ids:
+        transformed = transform_boxes(
+            np.array(lows), np.array(highs), np.array(matrices)
+        )
+        centers = np.concatenate(((transformed[0] + transformed[1]) / 2, centers))
+        low = np.concatenate((transformed[0], low))
+        high = np.concatenate((transformed[1], high))
+    return np.array(ids + unbounded, dtype=np.int64), low, high, centers
+
+
+def query_box(scene, low, high):
+    # ids of stagings whose bounds intersect the box from low to high
+    ids, lows, highs, _centers = scene_index(scene)
+    hits = np.all((lows <= high) & (highs >= low), axis=1)
+    return sorted(ids[hits].tolist())
+
+
+def query_radius(scene, center, radius):
+    # ids of stagings whose bounds are within radius of center
+    ids, lows, highs, _centers = scene_index(scene)
+    nearest = np.clip(center, lows, highs)
+    hits = ((nearest - center) ** 2).sum(axis=1) <= radius**2
+    return sorted(ids[hits].tolist())
+
+
+def scene_tiles(scene, size):
+    """
+    Splits stagings of scene in square tiles of the ground plane (X, Z)
+    by their centers. Returns a dictionary of "x,z" tile keys to tile
+    bounds (low, high) and sorted staging ids. Bounds contain the
+    stagings of the tile, the unknown ones as their centers.
+    """
+    ids, lows, highs, centers = scene_index(scene)
+    keys = np.floor(centers[:, [0, 2]] / size).astype(np.int64)
+    # infinite bounds would not fit in JSON
+    bounded = np.isfinite(lows).all(axis=1)
+    lows = np.where(bounded[:, None], lows, centers)
+    highs = np.where(bounded[:, None], highs, centers)
+    tiles = {}
+    unique, tile = np.unique(keys, axis=0, return_inverse=True)
+    for i, (x, z) in enumerate(unique.tolist()):
+        members = tile.reshape(-1) == i
+        tiles[f"{x},{z}"] = (
+            lows[members].min(axis=0),
+            highs[members].max(axis=0),
+            sorted(ids[members].tolist()),
+        )
+    return tiles
+
+
+def entity_changed(sender, instance, **kwargs):
+    get_cache().delete(entity_bounds_key(instance.id))
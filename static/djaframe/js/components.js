@@ -0,0 +1,216 @@
+/*------------------------------------
+  - A-Frame components
+  ------------------------------------*/
+
+/* Tints materials of glTF models generated from DXF (named "djaframe")
+   with the staging color, leaving uploaded models untouched. */
+AFRAME.registerComponent("djaframe-color", {
+  schema: {type: "color", default: "#FFFFFF"},
+
+  init: function () {
+    this.el.addEventListener("model-loaded", this.update.bind(this));
+  },
+
+  update: function () {
+    var mesh = this.el.getObject3D("mesh");
+    var color = this.data;
+    if (!mesh) {
+      return;
+    }
+    mesh.traverse(function (node) {
+      if (node.isMesh && node.material && node.material.name === "djaframe") {
+        node.material = node.material.clone();
+        node.material.color.set(color);
+      }
+    });
+  },
+});
+
+/* Swaps the model with simpler levels of detail as the camera moves
+   away, levels are "distance #asset-id" pairs separated by commas. */
+AFRAME.registerComponent("djaframe-lod", {
+  schema: {type: "string"},
+
+  init: function () {
+    this.attribute = this.el.hasAttribute("gltf-model") ? "gltf-model" : "obj-model";
+    this.base = this.attribute === "gltf-model"
+      ? this.el.getAttribute("gltf-model")
+      : this.el.getAttribute("obj-model").obj;
+    this.current = null;
+    this.box = null;
+    this.camera = new THREE.Vector3();
+    this.tick = AFRAME.utils.throttleTick(this.tick, 500, this);
+  },
+
+  update: function () {
+    this.levels = this.data.split(",").map(function (level) {
+      var parts = level.trim().split(" ");
+      return {distance: parseFloat(parts[0]), src: parts[1]};
+    }).sort(function (a, b) {
+      return a.distance - b.distance;
+    });
+  },
+
+  tick: function () {
+    var camera = this.el.sceneEl.camera;
+    if (!camera) {
+      return;
+    }
+    // world bounds of the full detail model, scenes are static
+    if (!this.box) {
+      if (!this.el.getObject3D("mesh")) {
+        return;
+      }
+      this.box = new THREE.Box3().setFromObject(this.el.object3D);
+    }
+    camera.getWorldPosition(this.camera);
+    var distance = this.box.distanceToPoint(this.camera);
+    var src = null;
+    this.levels.forEach(function (level) {
+      if (distance >= level.distance) {
+        src = level.src;
+      }
+    });
+    if (src === this.current) {
+      return;
+    }
+    this.current = src;
+    if (this.attribute === "gltf-model") {
+      this.el.setAttribute("gltf-model", src || this.base);
+    } else {
+      this.el.setAttribute("obj-model", "obj", src || this.base);
+    }
+  },
+});
+
+/* Loads stagings tile by tile, nearest to the camera first, from the
+   tile list at the given URL, so that models show up as soon as they
+   are loaded instead of waiting for the whole scene. */
+AFRAME.registerComponent("djaframe-tiles", {
+  schema: {type: "string"},
+
+  init: function () {
+    this.tiles = [];
+    this.loading = false;
+    this.box = new THREE.Box3();
+    this.camera = new THREE.Vector3();
+    this.tick = AFRAME.utils.throttleTick(this.tick, 200, this);
+  },
+
+  update: function () {
+    var self = this;
+    fetch(this.data)
+      .then(function (response) {
+        return response.json();
+      })
+      .then(function (data) {
+        self.tiles = data.tiles;
+      });
+  },
+
+  tick: function () {
+    var camera = this.el.sceneEl.camera;
+    var self = this;
+    var nearest = 0;
+    var best = Infinity;
+    if (this.loading || !this.tiles.length || !camera) {
+      return;
+    }
+    camera.getWorldPosition(this.camera);
+    this.tiles.forEach(function (tile, index) {
+      self.box.min.fromArray(tile.low);
+      self.box.max.fromArray(tile.high);
+      var distance = self.box.distanceToPoint(self.camera);
+      if (distance < best) {
+        best = distance;
+        nearest = index;
+      }
+    });
+    // one tile at a time, the camera may move meanwhile
+    this.loading = true;
+    fetch(this.tiles.splice(nearest, 1)[0].url)
+      .then(function (response) {
+        return response.json();
+      })
+      .then(function (data) {
+        self.addTile(data);
+      })
+      .finally(function () {
+        self.loading = false;
+      });
+  },
+
+  addTile: function (data) {
+    var assets = {};
+    var tile = document.createElement("a-entity");
+    data.assets.forEach(function (asset) {
+      assets[asset.id] = asset;
+    });
+    data.stagings.forEach(function (staging) {
+      var asset = assets[staging.entity];
+      var el = document.createElement("a-entity");
+      var model = document.createElement("a-entity");
+      var lods = asset.lods.map(function (lod) {
+        return lod.distance + " url(" + lod.url + ")";
+      });
+      el.setAttribute("position", staging.position);
+      el.setAttribute("rotation", staging.rotation);
+      el.setAttribute("scale", staging.scale);
+      if (asset.gltf) {
+        model.setAttribute("gltf-model", "url(" + asset.gltf + ")");
+        model.setAttribute("djaframe-color", staging.color);
+      } else {
+        model.setAttribute("obj-model", "obj", "url(" + asset.obj + ")");
+        if (asset.mtl) {
+          model.setAttribute("obj-model", "mtl", "url(" + asset.mtl + ")");
+        } else {
+          model.setAttribute("material", "color", staging.color);
+        }
+        if (asset.switch) {
+          model.setAttribute("rotation", "-90 0 0");
+        }
+      }
+      if (lods.length) {
+        model.setAttribute("djaframe-lod", lods.join(", "));
+      }
+      el.appendChild(model);
+      tile.appendChild(el);
+    });
+    this.el.appendChild(tile);
+  },
+});
+
+/* Swaps the sky with bigger levels of its resolution pyramid as they
+   load, levels are urls separated by commas, smallest first. Levels
+   wider than the GPU can take are skipped. */
+AFRAME.registerComponent("djaframe-sky", {
+  schema: {type: "string"},
+
+  update: function () {
+    var renderer = this.el.sceneEl.renderer;
+    this.max = renderer ? renderer.capabilities.maxTextureSize : Infinity;
+    this.urls = this.data.split(",").map(function (url) {
+      return url.trim();
+    });
+    this.level = 0;
+    this.next();
+  },
+
+  next: function () {
+    var url = this.urls[this.level];
+    if (!url) {
+      return;
+    }
+    var image = new Image();
+    image.crossOrigin = "anonymous";
+    image.addEventListener("load", function () {
+      if (image.naturalWidth > this.max || url !== this.urls[this.level]) {
+        return;
+      }
+      this.el.setAttribute("material", "src", image);
+      this.level++;
+      this.next();
+    }.bind(this));
+    image.src = url;
+  },
+});
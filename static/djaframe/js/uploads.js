@@ -0,0 +1,123 @@
+/*------------------------------------
+  - Chunked uploads
+  ------------------------------------*/
+
+/* Files bigger than a chunk, chosen in forms with a hidden
+   <field>_upload input, are sent chunk by chunk before the form is
+   submitted. Interrupted uploads resume from the offset the server
+   has, also after a reload of the page. */
+(function () {
+  var RETRIES = 10;
+
+  function csrfToken() {
+    var headers = document.body.getAttribute("hx-headers");
+    return headers ? JSON.parse(headers)["X-CSRFToken"] : "";
+  }
+
+  function request(method, url, body, headers) {
+    headers = Object.assign({"X-CSRFToken": csrfToken()}, headers || {});
+    return fetch(url, {method: method, body: body, headers: headers}).then(
+      function (response) {
+        return response.json().then(function (data) {
+          data.status = response.status;
+          return data;
+        });
+      }
+    );
+  }
+
+  function start(file, hidden) {
+    var key = "djaframe-upload:" + [file.name, file.size, file.lastModified].join(":");
+    var url = localStorage.getItem(key);
+    var resumed = url
+      ? request("GET", url).catch(function () {
+          return {status: 0};
+        })
+      : Promise.resolve({status: 404});
+    return resumed.then(function (upload) {
+      if (upload.status === 200) {
+        return upload;
+      }
+      var form = new FormData();
+      form.append("filename", file.name);
+      form.append("size", file.size);
+      return request("POST", hidden.dataset.uploadUrl, form).then(function (upload) {
+        if (upload.status !== 201) {
+          throw new Error("Upload refused");
+        }
+        localStorage.setItem(key, upload.url);
+        return upload;
+      });
+    }).then(function (upload) {
+      return send(file, hidden, upload, RETRIES).then(function (upload) {
+        localStorage.removeItem(key);
+        return upload;
+      });
+    });
+  }
+
+  function send(file, hidden, upload, retries) {
+    var size = parseInt(hidden.dataset.chunkSize, 10);
+    if (upload.offset === upload.size) {
+      return Promise.resolve(upload);
+    }
+    var end = Math.min(upload.offset + size, upload.size);
+    var range = "bytes " + upload.offset + "-" + (end - 1) + "/" + upload.size;
+    hidden.dispatchEvent(new CustomEvent("djaframe-upload-progress", {
+      bubbles: true,
+      detail: {offset: upload.offset, size: upload.size},
+    }));
+    return request("PUT", upload.url, file.slice(upload.offset, end), {
+      "Content-Range": range,
+    }).then(function (next) {
+      // 409: the server has another offset, go on from there
+      if (next.status !== 200 && next.status !== 409) {
+        throw new Error(next.error || "Upload failed");
+      }
+      return send(file, hidden, next, RETRIES);
+    }, function () {
+      if (!retries) {
+        throw new Error("Upload failed");
+      }
+      // dropped connection, ask for the offset and go on
+      return new Promise(function (resolve) {
+        setTimeout(resolve, 1000 * (RETRIES - retries + 1));
+      }).then(function () {
+        return request("GET", upload.url);
+      }).then(function (current) {
+        return send(file, hidden, current, retries - 1);
+      }, function () {
+        return send(file, hidden, upload, retries - 1);
+      });
+    });
+  }
+
+  document.addEventListener("change", function (event) {
+    var input = event.target;
+    if (input.type !== "file" || !input.form || !input.files.length) {
+      return;
+    }
+    var hidden = input.form.querySelector("input[name='" + input.name + "_upload']");
+    var file = input.files[0];
+    if (!hidden || file.size <= parseInt(hidden.dataset.chunkSize, 10)) {
+      return;
+    }
+    var buttons = input.form.querySelectorAll("[type=submit]");
+    buttons.forEach(function (button) {
+      button.disabled = true;
+    });
+    hidden.value = "";
+    start(file, hidden).then(function (upload) {
+      // the form sends the upload id instead of the file
+      hidden.value = upload.id;
+      input.value = "";
+      input.required = false;
+    }).catch(function (error) {
+      alert(file.name + ": " + error.message);
+    }).finally(function () {
+      buttons.forEach(function (button) {
+        button.disabled = false;
+      });
+    });
+  });
+})();
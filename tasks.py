@@ -0,0 +1,176 @@
+"""
+Local worker running DXF imports off the request path
+
+Import jobs are stored in the database, which acts as the queue:
+Scene.save() creates a pending ImportJob and hands its id to a thread
+pool once the transaction is committed. Jobs left pending (i.e. after
+a restart) are picked up by the djaframe_import management command,
+which also fails jobs left running by a stopped worker. Jobs of the
+same scene run one at a time. Material images without variants and
+scene images without a resolution pyramid are processed the same way.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import ImportJob, MaterialImage, Scene
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "DJAFRAME_IMPORT_WORKERS", 2),
+                thread_name_prefix="djaframe-import",
+            )
+    return _executor
+
+
+def enqueue(func, *args):
+    # DJAFRAME_IMPORT_WORKERS = 0 runs work inside the request
+    if getattr(settings, "DJAFRAME_IMPORT_WORKERS", 2) == 0:
+        func(*args)
+    else:
+        get_executor().submit(_run_in_thread, func, *args)
+
+
+def enqueue_import(job_id):
+    enqueue(run_import_job, job_id)
+
+
+def enqueue_texture(image_id):
+    from .textures import optimize_material_image
+
+    enqueue(optimize_material_image, image_id)
+
+
+def enqueue_sky(scene_id):
+    from .skies import generate_sky
+
+    enqueue(generate_sky, scene_id)
+
+
+def _run_in_thread(func, *args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception:
+        # the executor would keep it in a future nobody reads
+        logger.exception("%s%s failed", func.__name__, args)
+    finally:
+        close_old_connections()
+
+
+def claim_job(job_id):
+    """
+    Moves a job from pending to running and returns it, or None if
+    another worker claimed it or another job of its scene is running:
+    that one runs it when done, see run_import_job.
+    """
+    with transaction.atomic():
+        scene_id = (
+            ImportJob.objects.filter(id=job_id)
+            .values_list("scene_id", flat=True)
+            .first()
+        )
+        # claims of jobs of the same scene wait for each other
+        list(Scene.objects.select_for_update().filter(id=scene_id).values("id"))
+        running = ImportJob.objects.filter(
+            scene_id=OuterRef("scene_id"), status=ImportJob.Status.RUNNING
+        )
+        claimed = (
+            ImportJob.objects.filter(id=job_id, status=ImportJob.Status.PENDING)
+            .exclude(Exists(running))
+            .update(status=ImportJob.Status.RUNNING, started=timezone.now())
+        )
+    if not claimed:
+        return None
+    return ImportJob.objects.select_related("scene").get(id=job_id)
+
+
+def run_import_job(job_id):
+    job = claim_job(job_id)
+    if job is None:
+        return
+    try:
+        job.scene.import_dxf(progress=job.set_progress)
+    except Exception as e:
+        logger.exception("DXF import %s failed", job_id)
+        job.status = ImportJob.Status.FAILED
+        job.error = str(e)
+    else:
+        job.status = ImportJob.Status.DONE
+        job.progress = 100
+    job.finished = timezone.now()
+    job.save(update_fields=["status", "error", "progress", "finished"])
+    # a job of the scene queued while this one was running
+    pending = ImportJob.objects.filter(
+        scene_id=job.scene_id, status=ImportJob.Status.PENDING
+    )
+    next_id = pending.order_by("created").values_list("id", flat=True).first()
+    if next_id is not None:
+        run_import_job(next_id)
+
+
+def fail_stale_jobs(jobs=None):
+    """
+    Fails running jobs started more than DJAFRAME_IMPORT_TIMEOUT seconds
+    ago, whose worker was most likely stopped. Returns their number.
+    """
+    timeout = getattr(settings, "DJAFRAME_IMPORT_TIMEOUT", 3 * 3600)
+    jobs = ImportJob.objects.all() if jobs is None else jobs
+    return jobs.filter(
+        status=ImportJob.Status.RUNNING,
+        started__lt=timezone.now() - timedelta(seconds=timeout),
+    ).update(
+        status=ImportJob.Status.FAILED,
+        error="Import stopped or timed out, please upload the DXF file again",
+        finished=timezone.now(),
+    )
+
+
+def run_pending_jobs():
+    # oldest first, returns number of processed jobs
+    fail_stale_jobs()
+    pending = ImportJob.objects.filter(status=ImportJob.Status.PENDING)
+    job_ids = list(pending.order_by("created").values_list("id", flat=True))
+    for job_id in job_ids:
+        run_import_job(job_id)
+    return len(job_ids)
+
+
+def run_pending_textures():
+    # material images without variants, returns their number
+    from .textures import optimize_material_image
+
+    pending = MaterialImage.objects.filter(variants__isnull=True)
+    image_ids = list(pending.order_by("id").values_list("id", flat=True))
+    for image_id in image_ids:
+        optimize_material_image(image_id)
+    return len(image_ids)
+
+
+def run_pending_skies():
+    # scenes with an image and no pyramid, returns their number
+    from .skies import generate_sky
+
+    pending = Scene.objects.filter(sky_levels__isnull=True).exclude(
+        Q(image__isnull=True) | Q(image="")
+    )
+    scene_ids = list(pending.order_by("id").values_list("id", flat=True))
+    for scene_id in scene_ids:
+        generate_sky(scene_id)
+    return len(scene_ids)
@@ -1,13 +1,65 @@
+import hashlib
+import importlib
+import io
 import json  # noqa
+import os
+import struct
+import subprocess
+import sys
+from datetime import timedelta
+from pathlib import Path
 
+import ezdxf
+import numpy as np
 import pytest
 import time_machine
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.http import urlencode  # noqa
+from ezdxf.render import forms
 from mocket import mocketize
 from mocket.mockhttp import Entry  # noqa
+from PIL import Image
 from pytest_django.asserts import assertTemplateUsed
 
-from djaframe.models import Entity, Scene, Staging
+from djaframe.caching import render_scene
+from djaframe.geometry import (
+    MeshWriter,
+    SharedSpool,
+    cad_to_gltf,
+    cluster_vertices,
+    glb_dumps,
+    instanced_glb_dumps,
+    merge_meshes,
+    mesh_digest,
+    obj_dumps,
+    read_glb,
+    triangulate,
+)
+from djaframe.models import (
+    ChunkedUpload,
+    Entity,
+    ImportJob,
+    Scene,
+    Staging,
+    rotation_matrices_to_euler_angles_zyx,
+    rotation_matrix_to_euler_angles_zyx,
+)
+from djaframe.skies import generate_sky
+from djaframe.spatial import read_entity_bounds
+from djaframe.tasks import claim_job, fail_stale_jobs
+from djaframe.textures import optimize_material_image
+from djaframe.views import SceneCreateForm
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # ids are reused from test to test, as scene versions
+    caches["default"].clear()
 
 
 @mocketize(strict_mode=True)
@@ -367,3 +419,897 @@ def test_entity_list_view(client):
 
         assert response.status_code == 200
         assertTemplateUsed(response, "djaframe/htmx/entity_list.html")
+
+
+def test_triangulate_and_merge_meshes():
+    quad = triangulate([[0, 1, 2, 3], [0, 1]])
+    assert quad.tolist() == [[0, 1, 2], [0, 2, 3]]
+
+    square = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+    vertices, faces = merge_meshes([(square, quad), (square, quad)])
+    assert vertices.shape == (8, 3)
+    assert faces.tolist() == [[0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7]]
+
+
+@pytest.mark.django_db()
+def test_import_status_view(client):
+    scene = Scene.objects.create(title="DXF scene")
+    job = ImportJob.objects.create(scene=scene, progress=40)
+
+    response = client.get(
+        f"/3D/scene/{scene.id}/import/",
+        HTTP_HX_REQUEST="true",
+    )
+
+    assert response.status_code == 200
+    assertTemplateUsed(response, "djaframe/htmx/import_status.html")
+    assert "HX-Refresh" not in response.headers
+    assert "every 2s" in response.content.decode()
+
+    job.status = ImportJob.Status.DONE
+    job.save()
+    response = client.get(
+        f"/3D/scene/{scene.id}/import/",
+        HTTP_HX_REQUEST="true",
+    )
+
+    assert response.headers["HX-Refresh"] == "true"
+
+
+@pytest.mark.django_db()
+def test_scene_detail_view_assets(client, django_assert_num_queries):
+    scene = Scene.objects.create(title="Scene")
+    entity = Entity.objects.create(title="Chair", gltf_model="chair.glb")
+    other = Entity.objects.create(title="Table", gltf_model="table.glb")
+    for i in range(20):
+        Staging.objects.create(scene=scene, entity=entity, position=f"{i} 0 0")
+    Staging.objects.create(scene=scene, entity=other)
+
+    # scene, import job, stagings with entities, levels of detail,
+    # baked scene, instance groups
+    with django_assert_num_queries(6):
+        response = client.get(
+            f"/3D/scene/{scene.id}/",
+            HTTP_HX_REQUEST="true",
+        )
+
+    assert response.status_code == 200
+    content = response.content.decode()
+    assert content.count(f'id="gltf-file-{entity.id}"') == 1
+    assert content.count(f'gltf-model="#gltf-file-{entity.id}"') == 20
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize(
+    "backend",
+    [
+        "django.core.cache.backends.locmem.LocMemCache",
+        "django.core.cache.backends.filebased.FileBasedCache",
+    ],
+)
+def test_scene_markup_cache(backend, tmp_path, django_assert_num_queries):
+    with override_settings(
+        CACHES={"default": {"BACKEND": backend, "LOCATION": str(tmp_path)}}
+    ):
+        scene = Scene.objects.create(title="Scene")
+        entity = Entity.objects.create(title="Chair", obj_model="chair.obj")
+        staging = Staging.objects.create(scene=scene, entity=entity)
+        markup = render_scene(scene)
+
+        with django_assert_num_queries(0):
+            assert render_scene(scene) == markup
+
+        staging.color = "#FF0000"
+        staging.save()
+        scene.refresh_from_db()
+        assert "color: #FF0000" in render_scene(scene)
+
+        entity.mtl_model = "chair.mtl"
+        entity.save()
+        scene.refresh_from_db()
+        assert f"mtl: #mtl-file-{entity.id}" in render_scene(scene)
+
+        staging.delete()
+        scene.refresh_from_db()
+        assert "obj-model" not in render_scene(scene)
+
+
+@pytest.mark.django_db()
+def test_scene_save_queries(django_assert_num_queries):
+    scene = Scene.objects.create(title="Scene", dxf="plan.dxf")
+    scene.title = "Plan"
+    # the update and the new version, nothing to import
+    with django_assert_num_queries(2):
+        scene.save()
+    assert scene.version == 1
+    assert not scene.import_jobs.exists()
+
+
+@pytest.mark.django_db()
+def test_scene_manifest(client):
+    scene = Scene.objects.create(title="Scene")
+    entity = Entity.objects.create(title="Chair", gltf_model="chair.glb")
+    for i in range(3):
+        Staging.objects.create(scene=scene, entity=entity, position=f"{i} 0 0")
+
+    response = client.get(f"/3D/scene/{scene.id}/manifest/")
+
+    assert response.status_code == 200
+    manifest = response.json()
+    assert [asset["id"] for asset in manifest["assets"]] == [entity.id]
+    assert [st["position"] for st in manifest["stagings"]] == [
+        "0 0 0",
+        "1 0 0",
+        "2 0 0",
+    ]
+    etag = response.headers["ETag"]
+    assert not etag.startswith("W/")
+    assert "Last-Modified" in response.headers
+
+    response = client.get(f"/3D/scene/{scene.id}/manifest/", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+    Staging.objects.create(scene=scene, entity=entity)
+    response = client.get(f"/3D/scene/{scene.id}/manifest/", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert len(response.json()["stagings"]) == 4
+
+
+@pytest.mark.django_db()
+def test_bake_scene(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    scene = Scene.objects.create(title="Scene")
+    entity = Entity.objects.create(title="Square", switch=True)
+    entity.obj_model.save(
+        "square.obj", ContentFile(b"v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n")
+    )
+    Staging.objects.create(scene=scene, entity=entity, color="#FF0000")
+    Staging.objects.create(
+        scene=scene, entity=entity, position="5 0 0", rotation="0 90 0"
+    )
+    textured = Entity.objects.create(
+        title="Textured", obj_model="t.obj", mtl_model="t.mtl"
+    )
+    Staging.objects.create(scene=scene, entity=textured)
+    scene.refresh_from_db()
+
+    baked = scene.bake()
+
+    assert baked.entities == [entity.id]
+    assert scene.version == baked.version
+    with baked.model.open("rb") as f:
+        glb = f.read()
+    json_length = struct.unpack("<I", glb[12:16])[0]
+    gltf = json.loads(glb[20 : 20 + json_length])
+    # one mesh for each color, two triangles for each staging
+    assert len(gltf["meshes"]) == 2
+    assert sum(accessor["count"] for accessor in gltf["accessors"][1::2]) == 12
+    markup = render_scene(scene)
+    assert 'gltf-model="#baked-file"' in markup
+    assert f"obj-file-{entity.id}" not in markup
+    assert f"obj-file-{textured.id}" in markup
+
+    # stale as soon as the scene changes
+    Staging.objects.create(scene=scene, entity=entity)
+    scene.refresh_from_db()
+    assert "baked-file" not in render_scene(scene)
+
+
+@pytest.mark.django_db()
+def test_bake_scene_malformed(admin_client, tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    scene = Scene.objects.create(title="Scene")
+    square = ContentFile(b"v 0 0 0\nv 1 0 0\nv 1 1 0\nf 1 2 3\n", name="square.obj")
+    entity = Entity.objects.create(title="Square", obj_model=square)
+    Staging.objects.create(scene=scene, entity=entity)
+    chair = Entity.objects.create(title="Chair", obj_model=entity.obj_model.name)
+    Staging.objects.create(scene=scene, entity=chair)
+    bad = Staging.objects.create(scene=scene, entity=chair, position="1, 2, 3")
+
+    # the chair is left to A-Frame, and reported
+    response = admin_client.post(
+        reverse("admin:djaframe_scene_changelist"),
+        {"action": "bake", "_selected_action": [scene.id]},
+        follow=True,
+    )
+    assert f"of scene Scene: {bad.id}" in response.content.decode()
+    assert scene.baked.entities == [entity.id]
+
+
+@pytest.mark.django_db()
+def test_stagings_query(client, tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    scene = Scene.objects.create(title="Scene")
+    entity = Entity.objects.create(title="Square", switch=True)
+    entity.obj_model.save(
+        "square.obj", ContentFile(b"v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n")
+    )
+    near = Staging.objects.create(scene=scene, entity=entity)
+    far = Staging.objects.create(scene=scene, entity=entity, position="100 0 0")
+    # without a file bounds are unknown, it is always found
+    unknown = Entity.objects.create(title="Missing", gltf_model="missing.glb")
+    anywhere = Staging.objects.create(scene=scene, entity=unknown)
+    url = f"/3D/scene/{scene.id}/stagings/"
+
+    response = client.get(url, {"bbox": "-1,-1,-1,2,2,2"})
+    assert [st["id"] for st in response.json()["stagings"]] == [near.id, anywhere.id]
+    response = client.get(url, {"center": "100.5,0,-2", "radius": "1.5"})
+    assert [st["id"] for st in response.json()["stagings"]] == [far.id, anywhere.id]
+    response = client.get(url, {"center": "0,0,-3", "radius": "1.5"})
+    assert [st["id"] for st in response.json()["stagings"]] == [anywhere.id]
+    assert client.get(url, {"bbox": "1,2,3"}).status_code == 400
+
+
+@pytest.mark.django_db()
+def test_scene_tiles(client, tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    settings.DJAFRAME_TILE_SIZE = 10
+    settings.DJAFRAME_TILED_SCENE_SIZE = 3
+    scene = Scene.objects.create(title="Scene")
+    entity = Entity.objects.create(title="Square", switch=True)
+    entity.obj_model.save(
+        "square.obj", ContentFile(b"v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n")
+    )
+    stagings = [
+        Staging.objects.create(scene=scene, entity=entity, position=position)
+        for position in ("0 0 0", "2 0 0", "-20 0 0")
+    ]
+    scene.refresh_from_db()
+
+    markup = render_scene(scene)
+    assert f'djaframe-tiles="/3D/scene/{scene.id}/tiles/"' in markup
+    assert "obj-file" not in markup
+    tiles = client.get(f"/3D/scene/{scene.id}/tiles/").json()["tiles"]
+    assert {tile["key"]: tile["count"] for tile in tiles} == {"-2,-1": 1, "0,-1": 2}
+    tile = client.get(f"/3D/scene/{scene.id}/tiles/0,-1/").json()
+    assert [asset["id"] for asset in tile["assets"]] == [entity.id]
+    assert [st["id"] for st in tile["stagings"]] == [st.id for st in stagings[:2]]
+    assert client.get(f"/3D/scene/{scene.id}/tiles/5,5/").status_code == 404
+
+
+@pytest.mark.django_db()
+def test_check_material_file_name(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    entity = Entity.objects.create(title="Chair")
+    entity.obj_model.save(
+        "chair.obj", ContentFile(b"mtllib old.mtl\r\nv 0 0 0\r\n"), save=False
+    )
+    entity.mtl_model.save("chair.mtl", ContentFile(b"newmtl red\n"))
+    obj_path = Path(entity.obj_model.path)
+    obj_path.chmod(0o644)
+
+    assert entity.check_material_file_name()
+    assert obj_path.read_bytes() == b"mtllib chair.mtl\r\nv 0 0 0\r\n"
+    assert obj_path.stat().st_mode & 0o777 == 0o644
+    # no temporary file left behind
+    assert sorted(path.name for path in obj_path.parent.iterdir()) == [
+        "chair.mtl",
+        "chair.obj",
+    ]
+    # already right, the file is not replaced
+    inode = obj_path.stat().st_ino
+    assert not entity.check_material_file_name()
+    assert obj_path.stat().st_ino == inode
+    assert len(list(obj_path.parent.iterdir())) == 2
+
+
+@pytest.mark.django_db()
+def test_check_image_file_name(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    entity = Entity.objects.create(title="Chair")
+    entity.mtl_model.save(
+        "chair.mtl",
+        ContentFile(
+            b"newmtl wood\n"
+            b"map_Kd -s 1 1 1 textures\\wood.png\n"
+            b"map_Ka wood.jpg\n"
+            b"bump darkwood.jpg\n"
+            b"map_d missing.png\n"
+        ),
+    )
+    for name in ("wood.jpg", "darkwood.jpg", "wood.jpg"):
+        entity.material_images.create(image=ContentFile(b"", name=name))
+    mtl_path = Path(entity.mtl_model.path)
+
+    assert entity.check_image_file_name()
+    assert mtl_path.read_bytes() == (
+        b"newmtl wood\n"
+        b"map_Kd -s 1 1 1 wood.jpg\n"
+        b"map_Ka wood.jpg\n"
+        b"bump darkwood.jpg\n"
+        b"map_d missing.png\n"
+    )
+    # only the renamed image, mtl lines go to it
+    entity.material_images.get(image__endswith="/wood.jpg").delete()
+    assert entity.check_image_file_name()
+    renamed = entity.material_images.get(image__contains="/wood_").image.name
+    assert f"map_Kd -s 1 1 1 {Path(renamed).name}\n".encode() in mtl_path.read_bytes()
+    inode = mtl_path.stat().st_ino
+    assert not entity.check_image_file_name()
+    assert mtl_path.stat().st_ino == inode
+
+
+@pytest.mark.django_db()
+def test_optimize_material_image(tmp_path, settings, monkeypatch):
+    settings.MEDIA_ROOT = tmp_path
+    settings.DJAFRAME_TEXTURE_MIN_SIZE = 64
+    settings.DJAFRAME_TEXTURE_SIZE = 128
+    entity = Entity.objects.create(title="Chair")
+    entity.mtl_model.save("chair.mtl", ContentFile(b"map_Kd wood.jpg\n"))
+    f = io.BytesIO()
+    Image.new("RGB", (300, 200), "brown").save(f, "JPEG")
+    matimg = entity.material_images.create(
+        image=ContentFile(f.getvalue(), name="wood.jpg")
+    )
+    optimize_material_image(matimg.id)
+
+    matimg.refresh_from_db()
+    assert [(v["width"], v["height"], v["format"]) for v in matimg.variants] == [
+        (256, 128, "webp"),
+        (256, 128, "jpeg"),
+        (128, 64, "webp"),
+        (128, 64, "jpeg"),
+        (64, 32, "webp"),
+        (64, 32, "jpeg"),
+    ]
+    assert Path(entity.mtl_model.path).read_bytes() == b"map_Kd wood_128x64.webp\n"
+    settings.DJAFRAME_TEXTURE_WEBP = False
+    assert entity.check_image_file_name()
+    assert Path(entity.mtl_model.path).read_bytes() == b"map_Kd wood_128x64.jpeg\n"
+    # idempotent
+    optimize_material_image(matimg.id)
+    assert len(list(Path(matimg.image.path).parent.glob("wood_*"))) == 6
+    # too big for Pillow, left as it is
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    matimg = entity.material_images.create(
+        image=ContentFile(f.getvalue(), name="bomb.jpg")
+    )
+    optimize_material_image(matimg.id)
+    matimg.refresh_from_db()
+    assert matimg.variants == []
+
+
+@pytest.mark.django_db()
+def test_generate_sky(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    settings.DJAFRAME_SKY_MIN_WIDTH = 128
+    f = io.BytesIO()
+    Image.new("RGB", (512, 256), "skyblue").save(f, "JPEG")
+    scene = Scene.objects.create(
+        title="Sky", image=ContentFile(f.getvalue(), name="sky.jpg")
+    )
+    generate_sky(scene.id)
+
+    scene.refresh_from_db()
+    assert [(level["width"], level["height"]) for level in scene.sky_levels] == [
+        (64, 32),
+        (128, 64),
+        (256, 128),
+    ]
+    assert scene.version == 1
+    assert scene.sky_urls()[-1] == scene.image.url
+    markup = render_scene(scene)
+    assert f'<img id="sky-image" src="{scene.sky_urls()[0]}">' in markup
+    assert "djaframe-sky=" in markup
+    # idempotent, also when written again
+    generate_sky(scene.id)
+    Scene.objects.filter(id=scene.id).update(sky_levels=None)
+    generate_sky(scene.id)
+    assert Scene.objects.get(id=scene.id).sky_levels == scene.sky_levels
+    assert len(list(Path(scene.image.path).parent.glob("sky_*"))) == 3
+
+
+@pytest.mark.django_db()
+def test_entity_admin_forgets_generated_geometry(admin_client, tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    entity = Entity.objects.create(
+        title="Chair",
+        obj_model=ContentFile(b"v 0 0 0\n", name="chair.obj"),
+        content_hash="0" * 64,
+    )
+    lod = entity.lods.create(
+        distance=20, model=ContentFile(b"v 0 0 0\n", name="chair_lod1.obj")
+    )
+    url = reverse("admin:djaframe_entity_change", args=[entity.id])
+    data = {
+        "title": "Chair",
+        "description": "",
+        "material_images-TOTAL_FORMS": 0,
+        "material_images-INITIAL_FORMS": 0,
+        "lods-TOTAL_FORMS": 1,
+        "lods-INITIAL_FORMS": 1,
+        "lods-0-id": lod.id,
+        "lods-0-entity": entity.id,
+        "lods-0-level": 1,
+        "lods-0-distance": 20,
+        "lods-0-triangles": 0,
+    }
+    # saving without touching the model keeps the hash
+    assert admin_client.post(url, data).status_code == 302
+    entity.refresh_from_db()
+    assert entity.content_hash == "0" * 64
+    data["obj_model"] = SimpleUploadedFile("table.obj", b"v 1 1 1\n")
+    assert admin_client.post(url, data).status_code == 302
+    entity.refresh_from_db()
+    assert entity.content_hash is None
+    assert not entity.lods.exists()
+    assert not Path(lod.model.path).exists()
+
+
+@pytest.mark.django_db()
+def test_grant_chunkedupload():
+    from django.apps import apps
+    from django.contrib.auth.models import Group
+
+    migration = importlib.import_module("djaframe.migrations.0024_grant_chunkedupload")
+    group = Group.objects.get(name="3D Manager")
+    # a group created before chunked uploads
+    group.permissions.remove(*group.permissions.filter(codename="add_chunkedupload"))
+    migration.grant_chunkedupload(apps, None)
+    assert group.permissions.filter(codename="add_chunkedupload").exists()
+
+
+@pytest.mark.django_db()
+def test_chunked_upload(
+    admin_client,
+    admin_user,
+    client,
+    django_user_model,
+    tmp_path,
+    settings,
+    monkeypatch,
+    django_capture_on_commit_callbacks,
+):
+    settings.MEDIA_ROOT = tmp_path
+    content = b"0\nSECTION\n" * 100
+    response = admin_client.post(
+        "/3D/upload/",
+        {
+            "filename": "../plan.dxf",
+            "size": len(content),
+            "expected_sha256": hashlib.sha256(content).hexdigest(),
+        },
+    )
+    assert response.status_code == 201
+    url = response.json()["url"]
+
+    def put(start, end):
+        return admin_client.put(
+            url,
+            content[start:end],
+            content_type="application/octet-stream",
+            headers={"content-range": f"bytes {start}-{end - 1}/{len(content)}"},
+        )
+
+    assert put(0, 400).json()["offset"] == 400
+    # resumed at the wrong offset
+    assert put(500, 1000).status_code == 409
+    assert admin_client.get(url).json()["offset"] == 400
+    upload = put(400, 1000).json()
+    assert upload["sha256"] == hashlib.sha256(content).hexdigest()
+
+    # uploads of other users, files the form field refuses
+    other = django_user_model.objects.create(username="other")
+    data = {"title": "Plan", "dxf_upload": upload["id"]}
+    assert not SceneCreateForm(data, user=other).is_valid()
+    data["image_upload"] = upload["id"]
+    assert "image" in SceneCreateForm(data, user=admin_user).errors
+    response = admin_client.post("/3D/upload/", {"filename": "a.dxf", "size": 0})
+    assert response.status_code == 400
+    client.force_login(other)
+    response = client.post("/3D/upload/", {"filename": "a.dxf", "size": 1})
+    assert response.status_code == 403
+    assert response.json() == {"error": "Permission denied"}
+
+    form = SceneCreateForm(
+        {"title": "Plan", "dxf_upload": upload["id"]}, user=admin_user
+    )
+    assert form.is_valid()
+    # the file goes back to the upload if the scene can't be saved
+    chunked = tmp_path / ChunkedUpload.objects.get().file_name()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Database gone")
+
+    with monkeypatch.context() as m:
+        m.setattr(Scene, "save", fail)
+        with pytest.raises(RuntimeError):
+            form.save()
+    assert chunked.read_bytes() == content
+    assert not any((tmp_path / "uploads/djaframe/scene").iterdir())
+
+    with django_capture_on_commit_callbacks(execute=True):
+        scene = form.save()
+    assert scene.dxf.name == "uploads/djaframe/scene/plan.dxf"
+    assert Path(scene.dxf.path).read_bytes() == content
+    assert not ChunkedUpload.objects.exists()
+    assert not (tmp_path / "uploads/djaframe/chunked" / upload["id"]).exists()
+
+
+@pytest.mark.django_db()
+def test_import_jobs_of_a_scene(settings):
+    scene = Scene.objects.create(title="Plan")
+    running = scene.import_jobs.create(
+        status=ImportJob.Status.RUNNING, started=timezone.now()
+    )
+    scene.dxf = "uploads/djaframe/scene/a.dxf"
+    scene.save()
+    scene.dxf = "uploads/djaframe/scene/b.dxf"
+    scene.save()
+    superseded, pending = scene.import_jobs.exclude(id=running.id).order_by("id")
+    superseded.refresh_from_db()
+    assert superseded.status == ImportJob.Status.SUPERSEDED
+    # waits for the running job
+    assert claim_job(pending.id) is None
+    # worker stopped
+    settings.DJAFRAME_IMPORT_TIMEOUT = 60
+    with time_machine.travel(timezone.now() + timedelta(minutes=2)):
+        assert fail_stale_jobs() == 1
+    running.refresh_from_db()
+    assert running.status == ImportJob.Status.FAILED
+    assert claim_job(pending.id) == pending
+
+
+def dxf_file(chairs, walls=True, base_point=(0, 0, 0)):
+    # a Walls layer mesh and Chair block insertions at x of chairs
+    doc = ezdxf.new()
+    doc.layers.add("Walls", color=1)
+    doc.layers.add("Furniture", color=5)
+    forms.cube().render_mesh(doc.blocks.new("Chair", base_point=base_point))
+    msp = doc.modelspace()
+    if walls:
+        wall = forms.cube().scale(4, 0.2, 3)
+        wall.render_mesh(msp, dxfattribs={"layer": "Walls"})
+    for x in chairs:
+        msp.add_blockref("Chair", (x, 0, 0), dxfattribs={"layer": "Furniture"})
+    stream = io.StringIO()
+    doc.write(stream)
+    return ContentFile(stream.getvalue().encode(), name="plan.dxf")
+
+
+def import_scene(title, content, scene=None):
+    # the import job would run once the transaction commits
+    scene = scene or Scene.objects.create(title=title)
+    scene.dxf = content
+    scene.save()
+    scene.import_dxf()
+    return scene
+
+
+def chair_positions(scene):
+    return {
+        st.id: st.position for st in scene.staged_entities.filter(data__Block="Chair")
+    }
+
+
+@pytest.mark.django_db
+def test_dxf_import_block_base_point():
+    # the base point of the block lands on the insertion point
+    scene = import_scene("Base", dxf_file([2], walls=False, base_point=(1, 1, 0)))
+    assert list(chair_positions(scene).values()) == ["1.0 0.0 1.0"]
+
+
+@pytest.mark.django_db()
+def test_dxf_reimport(tmp_path, settings, monkeypatch):
+    settings.MEDIA_ROOT = tmp_path
+    scene = import_scene("Plan", dxf_file([0, 2, 4]))
+    before = chair_positions(scene)
+    assert scene.staged_entities.count() == 4
+    kept = {id for id, position in before.items() if position.startswith("0")}
+    assert len(kept) == 1
+
+    # the chair at 0 is unchanged, the one at 2 vanishes, 4 moves to 6;
+    # stale stagings are deleted without a receiver call each
+    calls = []
+    monkeypatch.setattr(
+        "djaframe.caching.delete_instance_groups", lambda groups: calls.append(groups)
+    )
+    import_scene("Plan", dxf_file([0, 6]), scene)
+    assert calls == []
+    after = chair_positions(scene)
+    assert len(after) == 2
+    assert kept < set(after)
+    moved = (set(after) - kept).pop()
+    assert moved not in before
+    assert after[moved].startswith("6")
+
+
+@pytest.mark.django_db()
+def test_dxf_reimport_orphans(tmp_path, settings, django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = tmp_path
+    scene = import_scene("Plan", dxf_file([0, 2]))
+    chair = Entity.objects.get(title="Block Chair")
+    chair_path = Path(chair.obj_model.path)
+    lamp = Entity.objects.create(title="Lamp")
+    by_hand = scene.staged_entities.create(entity=lamp)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        import_scene("Plan", dxf_file([]), scene)
+    assert not Entity.objects.filter(id=chair.id).exists()
+    assert not chair_path.exists()
+    assert Staging.objects.filter(id=by_hand.id).exists()
+    assert set(scene.staged_entities.values_list("entity__title", flat=True)) == {
+        "Lamp",
+        "Layer Walls",
+    }
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("streaming", [None, 0])
+@pytest.mark.parametrize("fmt", ["obj", "glb"])
+def test_dxf_import_bounds(tmp_path, settings, fmt, streaming):
+    settings.MEDIA_ROOT = tmp_path
+    settings.DJAFRAME_DXF_FORMAT = fmt
+    settings.DJAFRAME_STREAMING_IMPORT_SIZE = streaming
+    import_scene("Plan", dxf_file([0]))
+    walls = Entity.objects.get(title="Layer Walls")
+    assert walls.bounds == [[-2, -1.5, -0.1], [2, 1.5, 0.1]]
+    # the same as read from the file
+    recorded = read_entity_bounds(walls)
+    walls.bounds = None
+    assert np.allclose(read_entity_bounds(walls), recorded)
+
+
+@pytest.mark.django_db()
+def test_dxf_reimport_legacy_orphans(
+    tmp_path, settings, django_capture_on_commit_callbacks
+):
+    from django.apps import apps
+
+    settings.MEDIA_ROOT = tmp_path
+    migration = importlib.import_module(
+        "djaframe.migrations.0026_legacy_generated_entities"
+    )
+    scene = import_scene("Plan", dxf_file([0]))
+    # generated before content hashes
+    Entity.objects.update(content_hash=None)
+    lamp = Entity.objects.create(
+        title="Lamp", description="Generated by django-a-frame"
+    )
+    migration.mark_legacy_entities(apps, None)
+    chair = Entity.objects.get(title="Block Chair")
+    assert chair.content_hash == f"legacy-{chair.id}"
+    assert Entity.objects.get(id=lamp.id).content_hash is None
+
+    with django_capture_on_commit_callbacks(execute=True):
+        import_scene("Plan", dxf_file([]), scene)
+    assert not Entity.objects.filter(id=chair.id).exists()
+    assert not Path(chair.obj_model.path).exists()
+
+
+@pytest.mark.django_db()
+def test_dxf_import_reuses_entities(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    first = import_scene("First", dxf_file([0]))
+    second = import_scene("Second", dxf_file([0, 2], walls=False))
+    assert Entity.objects.count() == 2
+    assert set(second.staged_entities.values_list("entity", flat=True)) < set(
+        first.staged_entities.values_list("entity", flat=True)
+    )
+
+
+@pytest.mark.django_db()
+def test_dxf_import_rollback(tmp_path, settings, monkeypatch):
+    settings.MEDIA_ROOT = tmp_path
+
+    def fail(scene_ids):
+        raise RuntimeError("Database gone")
+
+    monkeypatch.setattr("djaframe.importer.touch_scenes", fail)
+    with pytest.raises(RuntimeError):
+        import_scene("Plan", dxf_file([0]))
+    assert not Entity.objects.exists()
+    assert not Staging.objects.exists()
+    assert not list((tmp_path / "uploads/djaframe/obj").glob("*/*"))
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize(
+    "mode",
+    [{"DJAFRAME_STREAMING_IMPORT_SIZE": 0}, {"DJAFRAME_IMPORT_PROCESSES": 2}],
+)
+@pytest.mark.parametrize("fmt", ["obj", "glb"])
+def test_dxf_import_modes(tmp_path, settings, mode, fmt):
+    settings.MEDIA_ROOT = tmp_path
+    settings.DJAFRAME_DXF_FORMAT = fmt
+
+    def imported():
+        scene = import_scene("Plan", dxf_file([0, 2]))
+        files = {
+            entity.title: (entity.obj_model or entity.gltf_model).read()
+            for entity in Entity.objects.all()
+        }
+        stagings = sorted(
+            scene.staged_entities.values_list(
+                "entity__title", "position", "rotation", "scale", "color", "data"
+            ),
+            key=str,
+        )
+        Entity.objects.all().delete()
+        return files, stagings
+
+    plain = imported()
+    assert len(plain[0]) == 2
+    for name, value in mode.items():
+        setattr(settings, name, value)
+    assert imported() == plain
+
+
+def test_read_glb():
+    square = [(0, 0, 0), (10, 0, 0), (10, 10, 0), (0, 10, 0.5)]
+    for precision in (None, 0.001):
+        glb = glb_dumps([(square, [[0, 1, 2, 3]])], precision=precision)
+        [(vertices, faces)] = read_glb(io.BytesIO(glb))
+        assert np.abs(vertices - [(x, z, -y) for x, y, z in square]).max() <= 0.001
+        assert faces.tolist() == [[0, 1, 2], [0, 2, 3]]
+
+
+def test_rotation_matrices_to_euler_angles_zyx():
+    c, s = np.cos(0.3), np.sin(0.3)
+    R = np.asarray(
+        [
+            # rotation about z
+            [[c, -s, 0], [s, c, 0], [0, 0, 1]],
+            # rotation about x
+            [[1, 0, 0], [0, c, -s], [0, s, c]],
+            # gimbal lock
+            [[0, 0, 1], [0, 1, 0], [-1, 0, 0]],
+        ]
+    )
+    z, y, x, gimbal_lock = rotation_matrices_to_euler_angles_zyx(R)
+    for i, matrix in enumerate(R):
+        expected = rotation_matrix_to_euler_angles_zyx(matrix)
+        assert np.allclose((z[i], y[i], x[i]), expected[:3])
+        assert gimbal_lock[i] == expected[3]
+
+
+def test_cluster_vertices():
+    # two triangles of a square, the second corner is 0.01 off
+    vertices = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (0.01, 0, 0)]
+    faces = [(0, 1, 2), (0, 2, 3), (0, 4, 3), (4, 1, 2)]
+
+    v, f = cluster_vertices(vertices, faces, 10)
+
+    # vertices 0 and 4 are merged, the collapsed and duplicate
+    # triangles are dropped
+    assert len(v) == 4
+    assert len(f) == 2
+    assert np.allclose(v[f[0]], [(0.005, 0, 0), (1, 0, 0), (1, 1, 0)])
+
+
+def test_glb_dumps():
+    square = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+    assert glb_dumps([(square, [[0, 1]])]) is None
+
+    glb = glb_dumps([(square, [[0, 1, 2, 3]])])
+    magic, version, length = struct.unpack("<4sII", glb[:12])
+    assert (magic, version, length) == (b"glTF", 2, len(glb))
+    json_length, chunk_type = struct.unpack("<I4s", glb[12:20])
+    assert chunk_type == b"JSON"
+    gltf = json.loads(glb[20 : 20 + json_length])
+    position, indices = gltf["accessors"]
+    assert position["count"] == 4
+    assert indices["count"] == 6
+    # CAD Y axis becomes glTF -Z axis
+    assert gltf["nodes"][0]["translation"] == [0.5, 0.0, -0.5]
+
+
+def test_glb_dumps_quantized():
+    square = [(0, 0, 0), (10, 0, 0), (10, 10, 0), (0, 10, 0.5)]
+    glb = glb_dumps([(square, [[0, 1, 2, 3]])], precision=0.001)
+
+    json_length = struct.unpack("<I", glb[12:16])[0]
+    gltf = json.loads(glb[20 : 20 + json_length])
+    assert gltf["extensionsRequired"] == ["KHR_mesh_quantization"]
+    position = gltf["accessors"][0]
+    view = gltf["bufferViews"][position["bufferView"]]
+    assert position["componentType"] == 5122
+    assert view["byteStride"] == 8
+    start = 20 + json_length + 8 + view["byteOffset"]
+    stored = np.frombuffer(glb[start : start + view["byteLength"]], dtype=np.int16)
+    node = gltf["nodes"][0]
+    decoded = stored.reshape(-1, 4)[:, :3] * node["scale"] + node["translation"]
+    # CAD Y axis becomes glTF -Z axis
+    expected = [(x, z, -y) for x, y, z in square]
+    assert np.abs(decoded - expected).max() <= 0.001
+
+    # too coarse for the required precision
+    assert glb_dumps([(square, [[0, 1, 2, 3]])], precision=1e-6) == glb_dumps(
+        [(square, [[0, 1, 2, 3]])]
+    )
+
+
+def test_instanced_glb_dumps():
+    square = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+    cos30, sin30 = np.cos(np.pi / 6), np.sin(np.pi / 6)
+    # translated, rotated 90 degrees around CAD Z axis, mirrored
+    matrices = np.array(
+        [
+            [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [5, 0, 0, 1]],
+            [[0, 1, 0, 0], [-1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]],
+            [[-1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]],
+            # rotated 30 degrees around CAD Z axis, scaled, translated
+            [
+                [2 * cos30, 2 * sin30, 0, 0],
+                [-3 * sin30, 3 * cos30, 0, 0],
+                [0, 0, 0.5, 0],
+                [1, 2, 3, 1],
+            ],
+        ],
+        dtype=np.float64,
+    )
+    colors = np.array([(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1)], dtype=np.float64)
+    glb = instanced_glb_dumps([(square, [[0, 1, 2, 3]])], matrices, colors)
+
+    json_length = struct.unpack("<I", glb[12:16])[0]
+    gltf = json.loads(glb[20 : 20 + json_length])
+    assert gltf["extensionsRequired"] == ["EXT_mesh_gpu_instancing"]
+    attributes = gltf["nodes"][0]["extensions"]["EXT_mesh_gpu_instancing"]["attributes"]
+    assert set(attributes) == {"TRANSLATION", "ROTATION", "SCALE", "_COLOR_0"}
+    for accessor in attributes.values():
+        assert gltf["accessors"][accessor]["count"] == 4
+
+    # instance transforms applied to the mesh give the inserted blocks
+    binary = glb[20 + json_length + 8 :]
+
+    def accessor_data(index):
+        accessor = gltf["accessors"][index]
+        view = gltf["bufferViews"][accessor["bufferView"]]
+        count = {"VEC3": 3, "VEC4": 4}[accessor["type"]]
+        offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+        return np.frombuffer(binary, "<f4", accessor["count"] * count, offset).reshape(
+            -1, count
+        )
+
+    mesh = gltf["meshes"][gltf["nodes"][0]["mesh"]]
+    positions = accessor_data(mesh["primitives"][0]["attributes"]["POSITION"])
+    translations = accessor_data(attributes["TRANSLATION"])
+    rotations = accessor_data(attributes["ROTATION"])
+    scales = accessor_data(attributes["SCALE"])
+    for matrix, t, (x, y, z, w), s in zip(matrices, translations, rotations, scales):
+        rotation = np.array(
+            [
+                [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+            ]
+        )
+        instanced = (positions * s) @ rotation.T + t
+        inserted = cad_to_gltf(np.array(square) @ matrix[:3, :3] + matrix[3, :3])
+        # float32 accessors
+        assert np.allclose(instanced, inserted, atol=1e-5)
+
+
+def test_geometry_without_django():
+    # spawned import workers unpickle convert_meshes with no settings
+    code = "import sys, djaframe.geometry; assert 'django' not in sys.modules"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_mesh_writer():
+    square = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+    triangle = [(0, 0, 1), (1, 0, 2), (0, 1, 3)]
+    meshes = [(square, [[0, 1, 2, 3]]), (triangle, [[0, 1, 2]])]
+    for fmt, dumps in (("obj", obj_dumps), ("glb", glb_dumps)):
+        writer = MeshWriter(fmt)
+        for vertices, faces in meshes:
+            writer.add(vertices, faces)
+        f = io.BytesIO()
+        getattr(writer, f"write_{fmt}")(f)
+        writer.close()
+        assert f.getvalue() == dumps(meshes)
+        assert writer.hexdigest() == mesh_digest(meshes, fmt)
+
+    # writers sharing a spool, with interleaved writes
+    spool = SharedSpool()
+    writers = [MeshWriter("obj", spool), MeshWriter("obj", spool)]
+    for vertices, faces in meshes:
+        for writer in writers:
+            writer.add(vertices, faces)
+    f = spool.open()
+    writers[0].write_obj(f)
+    f.seek(0)
+    assert f.read() == obj_dumps(meshes)
+    spool.close()
@@ -0,0 +1,121 @@
+"""
+Optimization of material images
+
+Uploaded textures are often much bigger than headsets and browsers can
+use. Each MaterialImage gets variants with power of two sizes, from
+DJAFRAME_TEXTURE_MAX_SIZE halving down to DJAFRAME_TEXTURE_MIN_SIZE
+(a mip chain), both as WebP and in a lossless or JPEG fallback. They
+are written by the background worker, next to the image, and MTL files
+are rewritten to the variant of the client profile, see
+MaterialImage.texture_name().
+"""
+
+import logging
+from io import BytesIO
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, UnidentifiedImageError
+
+from .caching import entity_scene_ids, touch_scenes
+from .models import MaterialImage
+
+logger = logging.getLogger(__name__)
+
+QUALITY = 85
+
+
+def floor_pow2(n):
+    return 1 << (max(int(n), 1).bit_length() - 1)
+
+
+def texture_levels(image, max_size, min_size):
+    """
+    Returns the mip chain of a Pillow image: copies with power of two
+    sides, the biggest not larger than the image nor max_size, then
+    halving until the larger side is min_size (or 1 pixel).
+    """
+    width = min(floor_pow2(image.width), floor_pow2(max_size))
+    height = min(floor_pow2(image.height), floor_pow2(max_size))
+    levels = []
+    while True:
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+        levels.append(image)
+        if max(width, height) <= min_size or (width, height) == (1, 1):
+            return levels
+        width, height = max(width // 2, 1), max(height // 2, 1)
+
+
+def encode_texture(image, fmt):
+    f = BytesIO()
+    if fmt == "webp":
+        image.save(f, "WEBP", quality=QUALITY, method=4)
+    elif fmt == "png":
+        image.save(f, "PNG")
+    else:
+        image.save(f, "JPEG", quality=QUALITY, optimize=True)
+    return f.getvalue()
+
+
+def texture_variants(f, max_size, min_size):
+    """
+    Yields (width, height, format, content) of the variants of image
+    file f: every level of the mip chain as WebP and as PNG, if it has
+    transparency, or JPEG.
+    """
+    with Image.open(f) as image:
+        alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if alpha else "RGB")
+    fallback = "png" if alpha else "jpeg"
+    for level in texture_levels(image, max_size, min_size):
+        for fmt in ("webp", fallback):
+            yield level.width, level.height, fmt, encode_texture(level, fmt)
+
+
+def optimize_material_image(image_id):
+    """
+    Writes variants of a material image, unless it has them already,
+    then points the MTL file of its entity to them. Images Pillow
+    can't read get no variants.
+    """
+    matimg = MaterialImage.objects.select_related("entity").filter(id=image_id).first()
+    if matimg is None or matimg.variants is not None:
+        return
+    image = matimg.image
+    stem = Path(image.name).stem
+    variants = []
+    try:
+        with image.open("rb") as f:
+            for width, height, fmt, content in texture_variants(
+                f,
+                getattr(settings, "DJAFRAME_TEXTURE_MAX_SIZE", 2048),
+                getattr(settings, "DJAFRAME_TEXTURE_MIN_SIZE", 128),
+            ):
+                name = image.storage.save(
+                    str(Path(image.name).with_name(f"{stem}_{width}x{height}.{fmt}")),
+                    ContentFile(content),
+                )
+                variants.append(
+                    {"width": width, "height": height, "format": fmt, "name": name}
+                )
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.exception("Optimization of material image %s failed", image_id)
+        delete_variants(variants, image.storage)
+        variants = []
+    # update() keeps save() from queueing it again
+    if not MaterialImage.objects.filter(id=image_id, variants__isnull=True).update(
+        variants=variants
+    ):
+        # optimized meanwhile by another worker
+        delete_variants(variants, image.storage)
+        return
+    entity = matimg.entity
+    if entity.mtl_model:
+        entity.check_image_file_name()
+    touch_scenes(entity_scene_ids(entity.id))
+
+
+def delete_variants(variants, storage):
+    for variant in variants or []:
+        storage.delete(variant["name"])
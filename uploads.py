@@ -0,0 +1,162 @@
+"""
+Chunked, resumable uploads
+
+Big model and DXF files are sent in chunks with a Content-Range
+header, each one appended to the file being assembled in the storage
+location and hashed as it arrives: if the connection drops, the
+client asks for the offset and sends the rest. The SHA-256 of the
+chunks received so far is kept by the process, a process without it
+hashes the file again up to the offset. Once complete, the file is
+moved (not copied) to the upload_to location of a file field, see
+attach_upload(). Assembling needs a storage with local paths, like
+the default FileSystemStorage.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import ChunkedUpload
+
+BLOCK_SIZE = 1 << 16
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+_hashers = {}
+_lock = threading.Lock()
+
+
+def parse_content_range(value):
+    # (start, end, total) of a "bytes start-end/total" header, end included
+    match = CONTENT_RANGE.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(f"Bad Content-Range: {value}")
+    start, end, total = map(int, match.groups())
+    if end < start or end >= total:
+        raise ValueError(f"Bad Content-Range: {value}")
+    return start, end, total
+
+
+def upload_hasher(upload, path):
+    """
+    Returns the SHA-256 of the first upload.offset bytes of the file,
+    the one kept since the last chunk if there is one.
+    """
+    with _lock:
+        offset, hasher = _hashers.pop(upload.id, (None, None))
+    if offset == upload.offset:
+        return hasher
+    # chunks received by another process, or before a restart
+    hasher = hashlib.sha256()
+    remaining = upload.offset
+    with open(path, "rb") as f:
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def append_chunk(upload, stream, length):
+    """
+    Writes up to length bytes of stream at the upload offset, hashing
+    them, and saves the new offset. Bytes received before a dropped
+    connection are kept, the error is raised again.
+    """
+    path = Path(default_storage.path(upload.file_name()))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    hasher = upload_hasher(upload, path)
+    received = 0
+    try:
+        with open(path, "r+b") as f:
+            # leftovers of an interrupted chunk are written again
+            f.seek(upload.offset)
+            f.truncate()
+            while received < length:
+                block = stream.read(min(BLOCK_SIZE, length - received))
+                if not block:
+                    break
+                f.write(block)
+                hasher.update(block)
+                received += len(block)
+    finally:
+        upload.offset += received
+        if upload.complete:
+            upload.sha256 = hasher.hexdigest()
+        else:
+            with _lock:
+                _hashers[upload.id] = (upload.offset, hasher)
+        upload.save(update_fields=["offset", "sha256", "modified"])
+    return received
+
+
+class UploadFile(File):
+    # read in place by form fields, like a temporary uploaded file
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def open_upload(upload):
+    # file of a complete upload, named as the client sent it
+    path = default_storage.path(upload.file_name())
+    return UploadFile(open(path, "rb"), name=upload.filename)
+
+
+def attach_upload(upload, instance, field_name):
+    """
+    Moves the file of a complete upload where the file field of the
+    instance uploads to and sets the field. Returns the new path, for
+    detach_upload() if the instance can't be saved, else the upload
+    is left to be deleted.
+    """
+    field = instance._meta.get_field(field_name)
+    storage = field.storage
+    name = storage.get_available_name(
+        field.generate_filename(instance, upload.filename),
+        max_length=field.max_length,
+    )
+    path = Path(storage.path(name))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(default_storage.path(upload.file_name()), path)
+    setattr(instance, field_name, name)
+    return path
+
+
+def detach_upload(upload, path):
+    # moves the file back, the upload can be attached again
+    os.replace(path, default_storage.path(upload.file_name()))
+
+
+def delete_upload(upload):
+    with _lock:
+        _hashers.pop(upload.id, None)
+    directory = Path(default_storage.path(upload.file_name())).parent
+    for path in directory.glob("*"):
+        path.unlink()
+    if directory.is_dir():
+        directory.rmdir()
+    upload.delete()
+
+
+def delete_expired_uploads():
+    # uploads left unfinished for DJAFRAME_UPLOAD_EXPIRY seconds
+    expiry = getattr(settings, "DJAFRAME_UPLOAD_EXPIRY", 7 * 24 * 3600)
+    expired = ChunkedUpload.objects.filter(
+        modified__lt=timezone.now() - timedelta(seconds=expiry)
+    )
+    count = 0
+    for upload in expired:
+        delete_upload(upload)
+        count += 1
+    return count
@@ -17,11 +17,18 @@ from .views import (
     StagingUpdateView,
     entity_delete,
     entity_unstaged_delete,
+    import_status,
     material_image_create,
     material_image_delete,
     scene_delete,
+    scene_manifest,
+    scene_tile,
+    scene_tile_list,
     staged_entity_create,
     staging_delete,
+    stagings_query,
+    upload_create,
+    upload_detail,
 )
 
 app_name = "djaframe"
@@ -44,9 +51,16 @@ urlpatterns = [
     path("scene/<pk>/", SceneDetailView.as_view(), name="scene_detail"),
     path("scene/<pk>/update/", SceneUpdateView.as_view(), name="scene_update"),
     path("scene/<pk>/delete/", scene_delete, name="scene_delete"),
+    path("scene/<pk>/import/", import_status, name="import_status"),
+    path("scene/<pk>/manifest/", scene_manifest, name="scene_manifest"),
+    path("scene/<pk>/stagings/", stagings_query, name="stagings_query"),
+    path("scene/<pk>/tiles/", scene_tile_list, name="scene_tile_list"),
+    path("scene/<pk>/tiles/<key>/", scene_tile, name="scene_tile"),
     path("scene/<pk>/staging/", StagingListView.as_view(), name="staging_list"),
     path("scene/<pk>/staging/add/", staged_entity_create, name="staging_create"),
     path("staging/<pk>/", StagingDetailView.as_view(), name="staging_detail"),
     path("staging/<pk>/update/", StagingUpdateView.as_view(), name="staging_update"),
     path("staging/<pk>/delete/", staging_delete, name="staging_delete"),
+    path("upload/", upload_create, name="upload_create"),
+    path("upload/<uuid:pk>/", upload_detail, name="upload_detail"),
 ]
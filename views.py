@@ -1,17 +1,55 @@
+from functools import partial, wraps
 from pathlib import Path
 from typing import Any
 
+import numpy as np
+from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.db.models.query import QuerySet
-from django.forms import CharField, ModelForm, TextInput
-from django.http import Http404, HttpResponseRedirect
+from django.forms import (
+    CharField,
+    FileField,
+    HiddenInput,
+    ModelForm,
+    TextInput,
+    UUIDField,
+)
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    UnreadablePostError,
+)
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
-from django.urls import reverse
+from django.urls import reverse, reverse_lazy
+from django.utils.text import get_valid_filename
+from django.views.decorators.http import condition, require_http_methods, require_POST
 from django.views.generic import CreateView, DetailView, ListView, UpdateView
 
-from .models import Entity, MaterialImage, Scene, Staging
+from .caching import (
+    render_scene,
+    scene_baked,
+    scene_instance_groups,
+    scene_stagings,
+)
+from .models import ChunkedUpload, Entity, ImportJob, MaterialImage, Scene, Staging
+from .spatial import query_box, query_radius, scene_tiles
+from .tasks import fail_stale_jobs
+from .textures import delete_variants
+from .uploads import (
+    append_chunk,
+    attach_upload,
+    delete_upload,
+    detach_upload,
+    open_upload,
+    parse_content_range,
+)
 
 
 class HtmxMixin:
@@ -48,6 +86,90 @@ class EntityUnstagedListView(HtmxMixin, ListView):
         return qs
 
 
+class ChunkedUploadMixin:
+    """
+    Adds a hidden <field>_upload input for each file field: the id of a
+    complete ChunkedUpload of the user, whose file is checked by the
+    form field and attached instead of one sent with the form.
+    """
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        self.uploads = {}
+        self.file_fields = [
+            name for name, field in self.fields.items() if isinstance(field, FileField)
+        ]
+        for name in self.file_fields:
+            self.fields[f"{name}_upload"] = UUIDField(
+                required=False,
+                widget=HiddenInput(
+                    attrs={
+                        "data-upload-url": reverse_lazy("djaframe:upload_create"),
+                        "data-chunk-size": getattr(
+                            settings, "DJAFRAME_UPLOAD_CHUNK_SIZE", 8 << 20
+                        ),
+                    }
+                ),
+            )
+            if self.data.get(f"{name}_upload"):
+                self.fields[name].required = False
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for name in self.file_fields:
+            upload_id = cleaned_data.get(f"{name}_upload")
+            if not upload_id:
+                continue
+            upload = ChunkedUpload.objects.filter(
+                id=upload_id, user_id=getattr(self.user, "id", None)
+            ).first()
+            if upload is None or not upload.complete:
+                self.add_error(name, "Upload missing or not complete")
+                continue
+            try:
+                with open_upload(upload) as f:
+                    self.fields[name].clean(
+                        f, self.get_initial_for_field(self.fields[name], name)
+                    )
+            except FileNotFoundError:
+                self.add_error(name, "Upload missing or not complete")
+                continue
+            except ValidationError as e:
+                self.add_error(name, e)
+                continue
+            self.uploads[name] = upload
+            # moved by save()
+            cleaned_data[name] = upload.file_name()
+        return cleaned_data
+
+    @property
+    def changed_data(self):
+        return super().changed_data + list(self.uploads)
+
+    def save(self, commit=True):
+        attached = []
+        try:
+            with transaction.atomic():
+                for name, upload in self.uploads.items():
+                    path = attach_upload(upload, self.instance, name)
+                    attached.append((upload, path))
+                    transaction.on_commit(partial(delete_upload, upload))
+                return super().save(commit)
+        except BaseException:
+            # nothing saved, files go back to their uploads
+            for upload, path in attached:
+                detach_upload(upload, path)
+            raise
+
+
+class UserFormMixin:
+    """Passes the user to the form, see ChunkedUploadMixin"""
+
+    def get_form_kwargs(self):
+        return super().get_form_kwargs() | {"user": self.request.user}
+
+
 class EntityCreateForm(ModelForm):
     class Meta:
         model = Entity
@@ -64,7 +186,7 @@ class EntityCreateView(PermissionRequiredMixin, HtmxMixin, CreateView):
         return reverse("djaframe:entity_update", kwargs={"pk": self.object.id})
 
 
-class EntityUpdateForm(ModelForm):
+class EntityUpdateForm(ChunkedUploadMixin, ModelForm):
     class Meta:
         model = Entity
         fields = (
@@ -77,13 +199,13 @@ class EntityUpdateForm(ModelForm):
         )
 
 
-class MaterialImageCreateForm(ModelForm):
+class MaterialImageCreateForm(ChunkedUploadMixin, ModelForm):
     class Meta:
         model = MaterialImage
         fields = ("image",)
 
 
-class EntityUpdateView(PermissionRequiredMixin, HtmxMixin, UpdateView):
+class EntityUpdateView(PermissionRequiredMixin, HtmxMixin, UserFormMixin, UpdateView):
     model = Entity
     permission_required = "djaframe.change_entity"
     form_class = EntityUpdateForm
@@ -94,6 +216,11 @@ class EntityUpdateView(PermissionRequiredMixin, HtmxMixin, UpdateView):
         context["matimg_form"] = MaterialImageCreateForm()
         return context
 
+    def form_valid(self, form):
+        if Entity.MODEL_FIELDS & set(form.changed_data):
+            form.instance.forget_generated_geometry()
+        return super().form_valid(form)
+
     def get_success_url(self):
         return reverse("djaframe:entity_detail", kwargs={"pk": self.object.id})
 
@@ -112,13 +239,15 @@ def material_image_create(request, pk):
     context = {"object": entity, "matimg_form": form}
     template_name = "djaframe/htmx/material_image_create.html"
     if request.method == "POST":
-        form = MaterialImageCreateForm(request.POST, request.FILES)
+        form = MaterialImageCreateForm(
+            request.POST,
+            request.FILES,
+            instance=MaterialImage(entity=entity),
+            user=request.user,
+        )
         if form.is_valid():
             # create material image
-            MaterialImage.objects.create(
-                entity=entity,
-                image=form.cleaned_data["image"],
-            )
+            form.save()
             return HttpResponseRedirect(
                 reverse("djaframe:matimg_create", kwargs={"pk": entity.id})
                 + "?refresh=True",
@@ -155,6 +284,7 @@ def material_image_delete(request, pk):
             Path(file).unlink()
     except FileNotFoundError:
         pass
+    delete_variants(matimg.variants, matimg.image.storage)
     matimg.delete()
     return TemplateResponse(
         request,
@@ -208,13 +338,13 @@ class SceneListView(HtmxMixin, ListView):
     template_name = "djaframe/htmx/scene_list.html"
 
 
-class SceneCreateForm(ModelForm):
+class SceneCreateForm(ChunkedUploadMixin, ModelForm):
     class Meta:
         model = Scene
         fields = ("title", "description", "dxf", "image")
 
 
-class SceneCreateView(PermissionRequiredMixin, HtmxMixin, CreateView):
+class SceneCreateView(PermissionRequiredMixin, HtmxMixin, UserFormMixin, CreateView):
     model = Scene
     permission_required = "djaframe.add_scene"
     form_class = SceneCreateForm
@@ -240,7 +370,7 @@ class StagingCreateForm(ModelForm):
         fields = ("entity", "position", "rotation", "scale", "color")
 
 
-class SceneUpdateView(PermissionRequiredMixin, HtmxMixin, UpdateView):
+class SceneUpdateView(PermissionRequiredMixin, HtmxMixin, UserFormMixin, UpdateView):
     model = Scene
     permission_required = "djaframe.change_scene"
     form_class = SceneCreateForm
@@ -321,6 +451,201 @@ class SceneDetailView(HtmxMixin, DetailView):
     model = Scene
     template_name = "djaframe/htmx/scene_detail.html"
 
+    def get_context_data(self, **kwargs: Any) -> dict[str, Any]:
+        context = super().get_context_data(**kwargs)
+        context["import_job"] = self.object.import_jobs.first()
+        context["scene_markup"] = render_scene(self.object)
+        return context
+
+
+def import_status(request, pk):
+    if not request.htmx:
+        raise Http404("Request without HTMX headers")
+    scene = get_object_or_404(Scene, id=pk)
+    fail_stale_jobs(scene.import_jobs.all())
+    job = scene.import_jobs.first()
+    context = {"object": scene, "import_job": job}
+    template_name = "djaframe/htmx/import_status.html"
+    # import finished, reload scene
+    if job is None or job.status == ImportJob.Status.DONE:
+        return TemplateResponse(
+            request,
+            template_name,
+            context,
+            headers={"HX-Refresh": "true"},
+        )
+    return TemplateResponse(
+        request,
+        template_name,
+        context,
+    )
+
+
+def scene_etag(request, pk, **kwargs):
+    version = Scene.objects.filter(id=pk).values_list("version", flat=True).first()
+    return None if version is None else f"scene-{pk}-{version}"
+
+
+def scene_last_modified(request, pk, **kwargs):
+    return Scene.objects.filter(id=pk).values_list("modified", flat=True).first()
+
+
+@condition(etag_func=scene_etag, last_modified_func=scene_last_modified)
+def scene_manifest(request, pk):
+    """
+    JSON with unique assets and staging transforms of the scene,
+    conditional requests get a 304 if the scene version is unchanged.
+    """
+    scene = get_object_or_404(Scene, id=pk)
+    stagings, assets = scene_stagings(scene)
+    groups = scene_instance_groups(scene, stagings)
+    baked = scene_baked(scene)
+    return JsonResponse(
+        {
+            "id": scene.id,
+            "title": scene.title,
+            "version": scene.version,
+            "image": url(scene.image),
+            "sky": [
+                {
+                    "width": level["width"],
+                    "height": level["height"],
+                    "url": scene.image.storage.url(level["name"]),
+                }
+                for level in scene.sky_levels or []
+            ],
+            "assets": [asset_json(entity) for entity in assets],
+            "instance_groups": [
+                {
+                    "entity": group.entity_id,
+                    "count": group.count,
+                    "url": url(group.model),
+                }
+                for group in groups
+            ],
+            "baked": (
+                {"url": url(baked.model), "entities": baked.entities} if baked else None
+            ),
+            "stagings": [staging_json(staging) for staging in stagings],
+        }
+    )
+
+
+@condition(etag_func=scene_etag, last_modified_func=scene_last_modified)
+def stagings_query(request, pk):
+    """
+    JSON with the stagings of the scene whose bounds intersect the box
+    bbox=x1,y1,z1,x2,y2,z2 or the sphere center=x,y,z&radius=r,
+    in A-Frame coordinates.
+    """
+    scene = get_object_or_404(Scene, id=pk)
+    try:
+        if "bbox" in request.GET:
+            bbox = np.array(request.GET["bbox"].split(","), dtype=np.float64)
+            low, high = bbox.reshape(2, 3)
+            ids = query_box(scene, np.minimum(low, high), np.maximum(low, high))
+        else:
+            center = np.array(request.GET["center"].split(","), dtype=np.float64)
+            ids = query_radius(scene, center.reshape(3), float(request.GET["radius"]))
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {"error": "Provide bbox=x1,y1,z1,x2,y2,z2 or center=x,y,z&radius=r"},
+            status=400,
+        )
+    stagings = scene.staged_entities.in_bulk(ids)
+    return JsonResponse(
+        {
+            "id": scene.id,
+            "version": scene.version,
+            "stagings": [staging_json(stagings[id]) for id in ids],
+        }
+    )
+
+
+@condition(etag_func=scene_etag, last_modified_func=scene_last_modified)
+def scene_tile_list(request, pk):
+    """
+    JSON with the tiles of the scene, their bounds and number of
+    stagings, in A-Frame coordinates.
+    """
+    scene = get_object_or_404(Scene, id=pk)
+    return JsonResponse(
+        {
+            "id": scene.id,
+            "version": scene.version,
+            "tiles": [
+                {
+                    "key": key,
+                    "url": reverse(
+                        "djaframe:scene_tile", kwargs={"pk": scene.id, "key": key}
+                    ),
+                    "low": low.tolist(),
+                    "high": high.tolist(),
+                    "count": len(ids),
+                }
+                for key, (low, high, ids) in scene_tiles(scene, tile_size()).items()
+            ],
+        }
+    )
+
+
+@condition(etag_func=scene_etag, last_modified_func=scene_last_modified)
+def scene_tile(request, pk, key):
+    """
+    JSON with assets and stagings of a tile of the scene, in the
+    format of the scene manifest.
+    """
+    scene = get_object_or_404(Scene, id=pk)
+    tile = scene_tiles(scene, tile_size()).get(key)
+    if tile is None:
+        raise Http404("No such tile")
+    stagings = scene.staged_entities.select_related("entity").in_bulk(tile[2])
+    stagings = [stagings[id] for id in tile[2]]
+    assets = list({st.entity_id: st.entity for st in stagings}.values())
+    prefetch_related_objects(assets, "lods")
+    return JsonResponse(
+        {
+            "key": key,
+            "assets": [asset_json(entity) for entity in assets],
+            "stagings": [staging_json(staging) for staging in stagings],
+        }
+    )
+
+
+def tile_size():
+    return getattr(settings, "DJAFRAME_TILE_SIZE", 50)
+
+
+def url(field_file):
+    return field_file.url if field_file else None
+
+
+def asset_json(entity):
+    return {
+        "id": entity.id,
+        "title": entity.title,
+        "gltf": url(entity.gltf_model),
+        "obj": url(entity.obj_model),
+        "mtl": url(entity.mtl_model),
+        "switch": entity.switch,
+        "lods": [
+            {"distance": lod.distance, "url": url(lod.model)}
+            for lod in entity.lods.all()
+        ],
+    }
+
+
+def staging_json(staging):
+    return {
+        "id": staging.id,
+        "entity": staging.entity_id,
+        "position": staging.position,
+        "rotation": staging.rotation,
+        "scale": staging.scale,
+        "color": staging.color,
+        "data": staging.data,
+    }
+
 
 class StagingDetailView(DetailView):
     model = Staging
@@ -358,3 +683,96 @@ def staging_delete(request, pk):
         template_name,
         context,
     )
+
+
+class ChunkedUploadCreateForm(ModelForm):
+    class Meta:
+        model = ChunkedUpload
+        fields = ("filename", "size", "expected_sha256")
+
+    def clean_filename(self):
+        return get_valid_filename(Path(self.cleaned_data["filename"]).name)
+
+    def clean_size(self):
+        # empty files have nothing to assemble
+        if self.cleaned_data["size"] == 0:
+            raise ValidationError("Empty files can't be uploaded in chunks")
+        return self.cleaned_data["size"]
+
+
+def upload_json(upload):
+    return {
+        "id": str(upload.id),
+        "url": reverse("djaframe:upload_detail", kwargs={"pk": upload.id}),
+        "filename": upload.filename,
+        "size": upload.size,
+        "offset": upload.offset,
+        "sha256": upload.sha256 or None,
+    }
+
+
+def json_permission_required(perm):
+    # scripts get a 403 instead of a redirect to the login page
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.has_perm(perm):
+                return JsonResponse({"error": "Permission denied"}, status=403)
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@require_POST
+@json_permission_required("djaframe.add_chunkedupload")
+def upload_create(request):
+    """
+    Starts a chunked upload of a file with filename and size, and
+    eventually its expected_sha256.
+    """
+    form = ChunkedUploadCreateForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    form.instance.user = request.user
+    upload = form.save()
+    return JsonResponse(upload_json(upload), status=201)
+
+
+@require_http_methods(["GET", "PUT", "DELETE"])
+@json_permission_required("djaframe.add_chunkedupload")
+def upload_detail(request, pk):
+    """
+    GET returns the offset to resume from, PUT appends the chunk in the
+    body at the offset given by its Content-Range header, DELETE drops
+    the upload. Chunks at another offset get a 409.
+    """
+    if request.method == "GET":
+        upload = get_object_or_404(ChunkedUpload, id=pk, user=request.user)
+        return JsonResponse(upload_json(upload))
+    with transaction.atomic():
+        # one chunk at a time
+        upload = get_object_or_404(
+            ChunkedUpload.objects.select_for_update(), id=pk, user=request.user
+        )
+        if request.method == "DELETE":
+            delete_upload(upload)
+            return HttpResponse(status=204)
+        try:
+            start, end, total = parse_content_range(
+                request.headers.get("Content-Range", "")
+            )
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        if total != upload.size or start != upload.offset:
+            return JsonResponse(upload_json(upload), status=409)
+        try:
+            append_chunk(upload, request, end - start + 1)
+        except UnreadablePostError:
+            # received bytes are kept, the client resumes from the offset
+            return JsonResponse(upload_json(upload), status=400)
+    if upload.complete and upload.expected_sha256 not in ("", upload.sha256):
+        delete_upload(upload)
+        return JsonResponse({"error": "SHA-256 mismatch"}, status=400)
+    return JsonResponse(upload_json(upload))